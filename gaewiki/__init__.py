@@ -9,10 +9,21 @@ from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
 from google.appengine.ext.webapp.util import run_wsgi_app
 
+import cache
 import handlers
 
 
-application = webapp.WSGIApplication(handlers.handlers)
+class WikiApplication(webapp.WSGIApplication):
+    """Empties the request cache before and after every request."""
+    def __call__(self, environ, start_response):
+        cache.clear_request_cache()
+        try:
+            return super(WikiApplication, self).__call__(environ, start_response)
+        finally:
+            cache.clear_request_cache()
+
+
+application = WikiApplication(handlers.handlers)
 
 
 sys.path.insert(0, os.path.dirname(__file__))
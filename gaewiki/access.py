@@ -2,25 +2,71 @@
 
 import re
 
+import cache
 import model
 import settings
-import util
+
+
+class AccessPolicy(object):
+    """Access control settings prepared for fast checks: patterns are compiled
+    and user lists are sets.  Built once per settings generation, see
+    get_policy()."""
+    def __init__(self, values):
+        self.whitelist = self.compile(values.get('page-whitelist'))
+        self.blacklist = self.compile(values.get('page-blacklist'))
+        self.readers = self.get_set(values.get('readers'))
+        self.editors = self.get_set(values.get('editors'))
+        self.open_reading = values.get('open-reading', 'yes')
+        self.open_editing = values.get('open-editing')
+        self.parents_must_exist = values.get('parents-must-exist') == 'yes'
+        self.image_uploading = values.get('image-uploading')
+
+    @staticmethod
+    def compile(pattern):
+        if pattern is None:
+            return None
+        return re.compile(pattern)
+
+    @staticmethod
+    def get_set(value):
+        if value is None:
+            return set()
+        if not isinstance(value, list):
+            value = [value]
+        return set(value)
+
+    def is_whitelisted(self, title):
+        return self.whitelist is not None and self.whitelist.match(title) is not None
+
+    def is_blacklisted(self, title):
+        if self.is_whitelisted(title):
+            return False
+        return self.blacklist is not None and self.blacklist.match(title) is not None
+
+    def is_reader(self, user):
+        """Returns True if the user is a global reader or editor."""
+        return user is not None and (user.email() in self.readers or user.email() in self.editors)
+
+
+# The (settings generation, AccessPolicy) pair used by the process.
+cached_policy = None
+
+
+def get_policy():
+    """Returns the access policy for current settings."""
+    global cached_policy
+    generation = cache.get_generation('settings')
+    if cached_policy is None or cached_policy[0] != generation:
+        cached_policy = (generation, AccessPolicy(settings.get_all()))
+    return cached_policy[1]
 
 
 def is_page_whitelisted(title):
-    pattern = settings.get('page-whitelist')
-    if pattern is None:
-        return False
-    return re.match(pattern, title) is not None
+    return get_policy().is_whitelisted(title)
 
 
 def is_page_blacklisted(title):
-    if is_page_whitelisted(title):
-        return False
-    pattern = settings.get('page-blacklist')
-    if pattern is None:
-        return False
-    return re.match(pattern, title) is not None
+    return get_policy().is_blacklisted(title)
 
 
 def can_edit_page(title, user=None, is_admin=False):
@@ -30,21 +76,22 @@ def can_edit_page(title, user=None, is_admin=False):
     if title.startswith('gaewiki:'):
         return False
 
-    if '/' in title and settings.get('parents-must-exist') == 'yes':
+    policy = get_policy()
+    if '/' in title and policy.parents_must_exist:
         parent_title = '/'.join(title.split('/')[:-1])
-        parent = model.WikiContent.gql('WHERE title = :1', parent_title).get()
+        parent = model.WikiContent.get_by_title(parent_title, create_if_none=False)
         if parent is None:
             return False
 
-    if settings.get('open-editing') == 'yes':
+    if policy.open_editing == 'yes':
         if not model.WikiContent.get_by_title(title).is_locked():
-            return not is_page_blacklisted(title)
+            return not policy.is_blacklisted(title)
     if user is None:
         return False
-    if settings.get('open-editing') == 'login':
-        return not is_page_blacklisted(title)
-    if user.email() in settings.get('editors', []):
-        return not is_page_blacklisted(title)
+    if policy.open_editing == 'login':
+        return not policy.is_blacklisted(title)
+    if user.email() in policy.editors:
+        return not policy.is_blacklisted(title)
     return False
 
 
@@ -59,46 +106,43 @@ def can_read_page(title, user, is_admin):
     if is_admin:
         return True
 
-    is_user_reader = user and (user.email() in settings.get('readers', []) or user.email() in settings.get('editors', []))
-    if is_user_reader:
+    policy = get_policy()
+    if policy.is_reader(user):
         return True
 
     page = model.WikiContent.get_by_title(title)
-    options = util.parse_page(page.body or '')
+    page.check_metadata()
 
-    is_open_wiki = settings.get('open-reading', 'yes') == 'yes'
-    if is_open_wiki:
-        if options.get('private') != 'yes':
+    if policy.open_reading == 'yes':
+        if not page.private:
             return True
-        return user and (user.email() in options.get('readers', []) or user.email() in options.get('editors', []))
-    elif settings.get('open-reading') == 'login':
-        return options.get('public') == 'yes' or user
+        return user and (user.email() in page.readers or user.email() in page.editors)
+    elif policy.open_reading == 'login':
+        return page.public or user
     else:
-        return options.get('public') == 'yes'
+        return page.public
 
 
 def can_see_most_pages(user, is_admin):
     if is_admin:
         return True
-    if settings.get('open-reading', 'yes') == 'yes':
+    policy = get_policy()
+    if policy.open_reading == 'yes':
         return True
     if user is None:
         return False
-    if settings.get('open-reading') == 'login':
+    if policy.open_reading == 'login':
         return True
-    if user.email() in settings.get('readers', []):
-        return True
-    if user.email() in settings.get('editors', []):
-        return True
-    return False
+    return policy.is_reader(user)
 
 
 def can_upload_image(user=None, is_admin=False):
     if is_admin:
         return True
 
-    if settings.get('image-uploading') == 'yes':
+    image_uploading = get_policy().image_uploading
+    if image_uploading == 'yes':
         return True
-    if user and settings.get('image-uploading') == 'login':
+    if user and image_uploading == 'login':
         return True
     return False
@@ -0,0 +1,53 @@
+# encoding=utf-8
+"""Micro-benchmarks for the rendering code.  Run with `make bench`."""
+
+import time
+
+from google.appengine.ext import testbed
+
+import markdown
+import settings
+import util
+
+
+SAMPLE_TEXT = u"""# Sample page
+
+Some *emphasized* text, a [link](http://example.com/) and `code`.
+
+- one
+- two
+- three
+
+> A quote.
+
+    indented code
+"""
+
+
+def measure(name, func, count=1000):
+    started = time.time()
+    for idx in xrange(count):
+        func(SAMPLE_TEXT)
+    spent = time.time() - started
+    print '%-40s %8.1f us per call' % (name, spent * 1000000 / count)
+
+
+def run_benchmarks():
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    try:
+        extensions = settings.get('markdown-extensions', [])
+        measure('markdown.markdown() (new converter)', lambda text: markdown.markdown(text, extensions))
+        measure('util.parse_markdown() (pooled)', util.parse_markdown)
+
+        converter = markdown.Markdown(extensions=markdown.load_extensions(extensions))
+        measure('converter construction only', lambda text: markdown.Markdown(extensions=markdown.load_extensions(extensions)))
+        measure('conversion only', lambda text: (converter.convert(text), converter.reset()))
+    finally:
+        bed.deactivate()
+
+
+if __name__ == '__main__':
+    run_benchmarks()
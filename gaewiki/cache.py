@@ -0,0 +1,280 @@
+# encoding=utf-8
+
+import cPickle
+import collections
+import hashlib
+import logging
+import os
+import threading
+import time
+import zlib
+
+from google.appengine.api import memcache
+
+
+# Returned by request_get() for keys that aren't cached, because None is a
+# valid cached value (e.g., "this page does not exist").
+MISSING = object()
+
+_local = threading.local()
+
+# Page parts that are rendered once and then shared by all pages.
+FRAGMENT_NAMES = ('sidebar', 'footer')
+
+# Values bigger than this are split in chunks, see set_large().  memcache
+# doesn't store items over 10^6 bytes, and the key and about 73 bytes of
+# overhead count towards that, so some room is left for them.
+CHUNK_SIZE = 1000 * 1000 - 1024
+
+# The first item of a chunk manifest, see set_large().
+MANIFEST = 'gaewiki:chunks'
+
+# Stored by a lease holder that failed to build the value, so that requests
+# waiting for it stop waiting, see wait_for_value().
+FAILED = 'gaewiki:failed'
+
+
+def get_request_storage():
+    """Returns the thread local storage of the current request.  The storage is
+    reset when a new request is detected, so stale data never leaks between
+    requests even if the storage wasn't cleared explicitly."""
+    request_id = os.environ.get('REQUEST_LOG_ID')
+    if getattr(_local, 'request_id', MISSING) != request_id:
+        _local.request_id = request_id
+        _local.data = {}
+        _local.hits = 0
+        _local.misses = 0
+    return _local
+
+
+def request_get(key):
+    """Returns a value cached for the current request, or MISSING."""
+    storage = get_request_storage()
+    value = storage.data.get(key, MISSING)
+    if value is MISSING:
+        storage.misses += 1
+    else:
+        storage.hits += 1
+    return value
+
+
+def request_set(key, value):
+    """Caches a value for the rest of the current request."""
+    get_request_storage().data[key] = value
+
+
+def request_delete(key):
+    get_request_storage().data.pop(key, None)
+
+
+def get_request_stats():
+    """Returns the number of cache hits and misses in the current request."""
+    storage = get_request_storage()
+    return {'hits': storage.hits, 'misses': storage.misses, 'size': len(storage.data)}
+
+
+def clear_request_cache():
+    """Empties the request cache, logs the statistics."""
+    stats = get_request_stats()
+    if stats['hits'] or stats['misses']:
+        logging.debug('Request cache: %(hits)u hits, %(misses)u misses, %(size)u items.' % stats)
+    _local.request_id = MISSING
+    get_request_storage()
+
+
+class LRUCache(object):
+    """A thread safe in-process cache of strings, limited by the total length
+    of the values.  Least recently used values are dropped first."""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.pop(key, None)
+            if value is not None:
+                self.items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.items[key] = value
+            self.size += len(value)
+            while self.size > self.max_size and self.items:
+                old_key, old = self.items.popitem(last=False)
+                self.size -= len(old)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+
+# Rendered page bodies, see get_rendered().
+render_cache = LRUCache(8 * 1024 * 1024)
+
+
+def get_generations(names):
+    """Returns a dictionary with current values of generation counters.
+    Counters are kept in memcache and read once per request, with a single
+    get_multi call for all the counters that weren't read yet.  When a
+    counter is lost it starts over from the current time in milliseconds, so
+    it never repeats older values."""
+    values = {}
+    missing = []
+    for name in names:
+        value = request_get(('generation', name))
+        if value is MISSING:
+            missing.append(name)
+        else:
+            values[name] = value
+
+    if missing:
+        loaded = memcache.get_multi(missing, key_prefix='Generation:')
+        new = dict([(name, int(time.time() * 1000)) for name in missing if name not in loaded])
+        if new:
+            for name in memcache.add_multi(new, key_prefix='Generation:'):
+                # Somebody else has just created it.
+                loaded[name] = memcache.get('Generation:' + name) or new[name]
+            new.update(loaded)
+            loaded = new
+        for name, value in loaded.items():
+            request_set(('generation', name), value)
+        values.update(loaded)
+
+    return values
+
+
+def get_generation(name):
+    """Returns the current value of a generation counter."""
+    return get_generations([name])[name]
+
+
+def bump_generations(names):
+    """Increments generation counters, which makes all values cached with
+    the previous values unreachable."""
+    memcache.offset_multi(dict([(name, 1) for name in names]), key_prefix='Generation:', initial_value=int(time.time() * 1000))
+    for name in names:
+        request_delete(('generation', name))
+
+
+def bump_generation(name):
+    bump_generations([name])
+
+
+def acquire_lease(key, seconds=30):
+    """Tries to become the only request that builds the value for the key.
+    Returns False if another request holds the lease.  The lease expires by
+    itself if its holder dies."""
+    return memcache.add('Lease:' + key, os.environ.get('REQUEST_LOG_ID') or 1, time=seconds)
+
+
+def release_lease(key):
+    memcache.delete('Lease:' + key)
+
+
+def wait_for_value(key, timeout=2.0, interval=0.1):
+    """Polls memcache until the value appears (built by the lease holder).
+    Returns None on timeout or if the lease holder failed."""
+    waited = 0
+    while waited < timeout:
+        time.sleep(interval)
+        waited += interval
+        value = get_large(key)
+        if value == FAILED:
+            return None
+        if value is not None:
+            return value
+    return None
+
+
+def mark_failed(key, seconds=5):
+    """Tells requests waiting for the value that it won't be built."""
+    memcache.set(key, FAILED, time=seconds)
+
+
+def set_large(key, value, seconds=0):
+    """Stores a value in memcache, even if it's bigger than memcache allows.
+    Big values are pickled and split in chunks, stored under random keys,
+    and the key gets a manifest: the chunk keys and the checksum of the
+    data.  The manifest is stored last, so it never points to chunks that
+    weren't stored.  Returns True on success."""
+    data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+    if len(data) <= CHUNK_SIZE:
+        return memcache.set(key, value, time=seconds)
+
+    prefix = 'Chunk:%s:' % os.urandom(8).encode('hex')
+    chunks = dict([(str(idx), data[offset:offset + CHUNK_SIZE]) for idx, offset in enumerate(range(0, len(data), CHUNK_SIZE))])
+    if memcache.set_multi(chunks, time=seconds, key_prefix=prefix):
+        logging.warning(u'Could not store %u bytes for %s.' % (len(data), key))
+        return False
+    manifest = (MANIFEST, prefix, len(chunks), hashlib.md5(data).hexdigest())
+    return memcache.set(key, manifest, time=seconds)
+
+
+def get_large(key):
+    """Returns a value stored with set_large() or None.  If any chunk was
+    evicted or doesn't match the checksum, the value is considered
+    missing."""
+    value = memcache.get(key)
+    if not isinstance(value, tuple) or len(value) != 4 or value[0] != MANIFEST:
+        return value
+
+    tag, prefix, count, checksum = value
+    names = [str(idx) for idx in range(count)]
+    chunks = memcache.get_multi(names, key_prefix=prefix)
+    if len(chunks) != count:
+        logging.debug(u'Chunks of %s were evicted.' % key)
+        return None
+    data = ''.join([chunks[name] for name in names])
+    if hashlib.md5(data).hexdigest() != checksum:
+        logging.warning(u'Chunks of %s are damaged.' % key)
+        return None
+    return cPickle.loads(data)
+
+
+def get_rendered(key):
+    """Returns rendered HTML from the in-process cache, then from memcache."""
+    html = render_cache.get(key)
+    if html is None:
+        html = get_large('Render:' + key)
+        if html is not None:
+            render_cache.set(key, html)
+    return html
+
+
+def set_rendered(key, html):
+    render_cache.set(key, html)
+    set_large('Render:' + key, html)
+
+
+def gzip_compress(text):
+    """Returns the text compressed in the gzip format, as sent to clients
+    with Content-Encoding: gzip."""
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(text) + compressor.flush()
+
+
+def gzip_decompress(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS).decode('utf-8')
+
+
+def get_fragment(name):
+    """Returns a rendered page fragment (e.g., the sidebar) or None."""
+    return memcache.get('Fragment:' + name)
+
+
+def set_fragment(name, html):
+    memcache.set('Fragment:' + name, html)
+
+
+def flush_fragments():
+    """Drops all rendered fragments, they are rendered again when needed."""
+    memcache.delete_multi(list(FRAGMENT_NAMES), key_prefix='Fragment:')
@@ -0,0 +1,243 @@
+# encoding=utf-8
+"""Differences between page texts, used to store revisions compactly and
+to show what was changed."""
+
+import cgi
+import re
+import zlib
+
+from django.utils import simplejson
+
+
+# Searches for the shortest edit path give up after this many edits and
+# treat the remaining parts as replaced, which keeps the worst case time in
+# check at the cost of a longer (but still correct) diff.
+MAX_EDITS = 1000
+
+
+def get_opcodes(a, b):
+    """Returns differences between two sequences as a list of (tag, i1, i2,
+    j1, j2) tuples, like difflib.SequenceMatcher.get_opcodes().  Uses the
+    linear space variation of Myers' O(ND) algorithm, which needs no more
+    memory than the sequences themselves."""
+    ids = {}
+    a = [ids.setdefault(item, len(ids)) for item in a]
+    b = [ids.setdefault(item, len(ids)) for item in b]
+    runs = []
+    _find_runs(a, b, 0, len(a), 0, len(b), runs)
+
+    opcodes = []
+    i = j = 0
+    for x, y, length in runs + [(len(a), len(b), 0)]:
+        if i < x and j < y:
+            opcodes.append(('replace', i, x, j, y))
+        elif i < x:
+            opcodes.append(('delete', i, x, j, y))
+        elif j < y:
+            opcodes.append(('insert', i, x, j, y))
+        if length:
+            if opcodes and opcodes[-1][0] == 'equal':
+                opcodes[-1] = ('equal', opcodes[-1][1], x + length, opcodes[-1][3], y + length)
+            else:
+                opcodes.append(('equal', x, x + length, y, y + length))
+        i, j = x + length, y + length
+    return opcodes
+
+
+def _find_runs(a, b, a0, a1, b0, b1, runs):
+    """Appends runs of matching items, (x, y, length) tuples, to the list."""
+    length = 0
+    while a0 + length < a1 and b0 + length < b1 and a[a0 + length] == b[b0 + length]:
+        length += 1
+    if length:
+        runs.append((a0, b0, length))
+        a0 += length
+        b0 += length
+
+    suffix = 0
+    while a1 - suffix > a0 and b1 - suffix > b0 and a[a1 - suffix - 1] == b[b1 - suffix - 1]:
+        suffix += 1
+    a1 -= suffix
+    b1 -= suffix
+
+    if a0 < a1 and b0 < b1:
+        split = _find_split(a, b, a0, a1, b0, b1)
+        if split is not None:
+            x, y = split
+            _find_runs(a, b, a0, x, b0, y, runs)
+            _find_runs(a, b, x, a1, y, b1, runs)
+
+    if suffix:
+        runs.append((a1, b1, suffix))
+
+
+def _find_split(a, b, a0, a1, b0, b1):
+    """Returns a point on the shortest edit path, where the paths searched
+    from both ends at once meet, or None if the texts have nothing in
+    common (or too little to be worth finding out, see MAX_EDITS).  The
+    texts must differ at both ends."""
+    n = a1 - a0
+    m = b1 - b0
+    delta = n - m
+    odd = delta % 2 != 0
+    max_d = min((n + m + 1) / 2, MAX_EDITS)
+    offset = max_d + 1
+    size = 2 * offset + 1
+    forward = [-1] * size
+    backward = [-1] * size
+    forward[offset + 1] = 0
+    backward[offset + 1] = 0
+    # Diagonals that left the edit graph are skipped.
+    k1start = k1end = k2start = k2end = 0
+
+    for d in xrange(max_d):
+        for k in xrange(-d + k1start, d + 1 - k1end, 2):
+            if k == -d or (k != d and forward[offset + k - 1] < forward[offset + k + 1]):
+                x = forward[offset + k + 1]
+            else:
+                x = forward[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[a0 + x] == b[b0 + y]:
+                x += 1
+                y += 1
+            forward[offset + k] = x
+            if x > n:
+                k1end += 2
+            elif y > m:
+                k1start += 2
+            elif odd:
+                other = offset + delta - k
+                if 0 <= other < size and backward[other] != -1 and x >= n - backward[other]:
+                    return a0 + x, b0 + y
+
+        for k in xrange(-d + k2start, d + 1 - k2end, 2):
+            if k == -d or (k != d and backward[offset + k - 1] < backward[offset + k + 1]):
+                x = backward[offset + k + 1]
+            else:
+                x = backward[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[a1 - x - 1] == b[b1 - y - 1]:
+                x += 1
+                y += 1
+            backward[offset + k] = x
+            if x > n:
+                k2end += 2
+            elif y > m:
+                k2start += 2
+            elif not odd:
+                other = offset + delta - k
+                if 0 <= other < size and forward[other] != -1 and forward[other] >= n - x:
+                    fx = forward[other]
+                    return a0 + fx, b0 + fx - (delta - k)
+
+    return None
+
+
+def make_delta(old, new):
+    """Returns compressed instructions that turn the old text into the new
+    one, see apply_delta().  The instructions are a list of numbers of
+    lines to copy (positive) or skip (negative) and strings to insert."""
+    a = old.splitlines(True)
+    b = new.splitlines(True)
+    ops = []
+    for tag, i1, i2, j1, j2 in get_opcodes(a, b):
+        if tag == 'equal':
+            ops.append(i2 - i1)
+            continue
+        if i2 > i1:
+            ops.append(i1 - i2)
+        if j2 > j1:
+            ops.append(u''.join(b[j1:j2]))
+    return zlib.compress(simplejson.dumps(ops))
+
+
+def apply_delta(old, delta):
+    """Returns the text produced by applying the delta to the old text."""
+    a = old.splitlines(True)
+    result = []
+    pos = 0
+    for op in simplejson.loads(zlib.decompress(delta)):
+        if isinstance(op, basestring):
+            result.append(op)
+        elif op > 0:
+            result.extend(a[pos:pos + op])
+            pos += op
+        else:
+            pos -= op
+    return u''.join(result)
+
+
+# Unchanged lines shown around changes.
+CONTEXT_LINES = 3
+
+# Changed blocks up to this many lines are compared word by word.
+WORD_DIFF_LINES = 50
+
+WORD_PATTERN = re.compile(r'\n|[^\S\n]+|\w+|[^\w\s]', re.U)
+
+
+def render_html(old, new):
+    """Yields the HTML table with differences between two texts, piece by
+    piece, so that differences of big pages are never held in one string
+    before they are joined.  Long unchanged parts are collapsed."""
+    a = old.splitlines()
+    b = new.splitlines()
+    yield u'<table class="table table-condensed diff">'
+    opcodes = get_opcodes(a, b)
+    for idx, (tag, i1, i2, j1, j2) in enumerate(opcodes):
+        if tag == 'equal':
+            head = idx and CONTEXT_LINES or 0
+            tail = idx < len(opcodes) - 1 and CONTEXT_LINES or 0
+            if i2 - i1 > head + tail:
+                for row in range(head):
+                    yield _render_row('same', i1 + row, j1 + row, cgi.escape(a[i1 + row]))
+                yield u'<tr class="diff-skip"><td></td><td></td><td>\u2026</td></tr>'
+                for row in range(i2 - i1 - tail, i2 - i1):
+                    yield _render_row('same', i1 + row, j1 + row, cgi.escape(a[i1 + row]))
+            else:
+                for row in range(i2 - i1):
+                    yield _render_row('same', i1 + row, j1 + row, cgi.escape(a[i1 + row]))
+            continue
+
+        if tag == 'replace' and i2 - i1 + j2 - j1 <= WORD_DIFF_LINES:
+            old_lines, new_lines = _mark_words(u'\n'.join(a[i1:i2]), u'\n'.join(b[j1:j2]))
+        else:
+            old_lines = [cgi.escape(line) for line in a[i1:i2]]
+            new_lines = [cgi.escape(line) for line in b[j1:j2]]
+        for row, line in enumerate(old_lines):
+            yield _render_row('del', i1 + row, None, line)
+        for row, line in enumerate(new_lines):
+            yield _render_row('ins', None, j1 + row, line)
+    yield u'</table>'
+
+
+def _render_row(kind, old_number, new_number, html):
+    return u'<tr class="diff-%s"><td>%s</td><td>%s</td><td>%s</td></tr>' % (
+        kind,
+        old_number is not None and old_number + 1 or u'',
+        new_number is not None and new_number + 1 or u'',
+        html)
+
+
+def _mark_words(old, new):
+    """Returns lines of both texts with changed words marked with <del> and
+    <ins> tags."""
+    a = WORD_PATTERN.findall(old)
+    b = WORD_PATTERN.findall(new)
+    old_html = []
+    new_html = []
+    for tag, i1, i2, j1, j2 in get_opcodes(a, b):
+        if tag == 'equal':
+            text = cgi.escape(u''.join(a[i1:i2]))
+            old_html.append(text)
+            new_html.append(text)
+        else:
+            old_html.append(_wrap_lines(u''.join(a[i1:i2]), u'del'))
+            new_html.append(_wrap_lines(u''.join(b[j1:j2]), u'ins'))
+    return u''.join(old_html).split(u'\n'), u''.join(new_html).split(u'\n')
+
+
+def _wrap_lines(text, tag):
+    """Wraps every line of the text in the tag separately, so that the text
+    can be split into lines afterwards."""
+    return u'\n'.join([line and u'<%s>%s</%s>' % (tag, cgi.escape(line), tag) or u'' for line in text.split(u'\n')])
@@ -0,0 +1,137 @@
+# encoding=utf-8
+"""Link graph reports, see model.LinkReport and handlers.LinkReportBuildHandler."""
+
+import array
+
+
+# Entries kept in each report.
+REPORT_SIZE = 500
+
+# PageRank parameters: the probability to follow a link rather than jump to
+# a random page, the maximum number of iterations and the total change of
+# ranks at which the iterations stop.
+DAMPING = 0.85
+MAX_ITERATIONS = 30
+TOLERANCE = 1e-6
+
+
+class LinkGraph(object):
+    """Pages and links between them, in a compact form: titles are numbered,
+    links of each page are arrays of numbers.  Links to pages that don't
+    exist are numbered too, they are told apart by self.exists.  Links with
+    one of the ignored prefixes (e.g., List: or interwiki links) don't lead
+    to pages and are left out."""
+    def __init__(self, ignored_prefixes=()):
+        self.ignored_prefixes = frozenset(ignored_prefixes)
+        self.titles = []
+        self.ids = {}
+        self.exists = []
+        self.links = []
+
+    def get_id(self, title):
+        title = title.replace('_', ' ')
+        node = self.ids.get(title)
+        if node is None:
+            node = self.ids[title] = len(self.titles)
+            self.titles.append(title)
+            self.exists.append(False)
+            self.links.append(None)
+        return node
+
+    def add_page(self, title, links):
+        """Adds a page and its links, each linked page is counted once and
+        links to itself are ignored."""
+        node = self.get_id(title)
+        self.exists[node] = True
+        targets = set([self.get_id(link) for link in links if self.is_page_link(link)])
+        targets.discard(node)
+        self.links[node] = array.array('i', sorted(targets))
+
+    def is_page_link(self, link):
+        prefix = link.split(':', 1)[0]
+        return prefix == link or ' ' in prefix or prefix not in self.ignored_prefixes
+
+    def get_pages(self):
+        return [node for node in range(len(self.titles)) if self.exists[node]]
+
+    def count_backlinks(self):
+        counts = [0] * len(self.titles)
+        for node in self.get_pages():
+            for target in self.links[node]:
+                counts[target] += 1
+        return counts
+
+    def get_orphans(self):
+        """Returns titles of pages that no other page links to."""
+        counts = self.count_backlinks()
+        return sorted([self.titles[node] for node in self.get_pages() if not counts[node]])
+
+    def get_wanted(self, limit=REPORT_SIZE):
+        """Returns (title, count) tuples for missing pages with the most
+        links to them."""
+        counts = self.count_backlinks()
+        wanted = [(self.titles[node], count) for node, count in enumerate(counts) if count and not self.exists[node]]
+        return sorted(wanted, key=lambda item: (-item[1], item[0]))[:limit]
+
+    def get_dead_links(self, limit=REPORT_SIZE):
+        """Returns (title, missing titles) tuples for pages with the most
+        links to pages that don't exist."""
+        dead = []
+        for node in self.get_pages():
+            missing = [self.titles[target] for target in self.links[node] if not self.exists[target]]
+            if missing:
+                dead.append((self.titles[node], sorted(missing)))
+        return sorted(dead, key=lambda item: (-len(item[1]), item[0]))[:limit]
+
+    def get_ranks(self):
+        """Returns PageRank of every existing page, as a list indexed by page
+        numbers.  Links to missing pages are ignored, rank of pages without
+        links is spread evenly over all pages."""
+        pages = self.get_pages()
+        if not pages:
+            return []
+        outgoing = {}
+        for node in pages:
+            outgoing[node] = [target for target in self.links[node] if self.exists[target]]
+        share = 1.0 / len(pages)
+        ranks = [0.0] * len(self.titles)
+        for node in pages:
+            ranks[node] = share
+
+        for iteration in range(MAX_ITERATIONS):
+            new = [0.0] * len(self.titles)
+            dangling = 0.0
+            for node in pages:
+                targets = outgoing[node]
+                if targets:
+                    part = ranks[node] / len(targets)
+                    for target in targets:
+                        new[target] += part
+                else:
+                    dangling += ranks[node]
+            base = (1 - DAMPING + DAMPING * dangling) * share
+            change = 0.0
+            for node in pages:
+                new[node] = base + DAMPING * new[node]
+                change += abs(new[node] - ranks[node])
+            ranks = new
+            if change < TOLERANCE:
+                break
+        return ranks
+
+    def get_important(self, limit=REPORT_SIZE):
+        """Returns (title, rank) tuples for pages with the highest PageRank,
+        ranks are scaled so that the average page has 1."""
+        ranks = self.get_ranks()
+        scale = len(self.get_pages())
+        important = [(self.titles[node], round(ranks[node] * scale, 3)) for node in self.get_pages()]
+        return sorted(important, key=lambda item: (-item[1], item[0]))[:limit]
+
+    def get_reports(self):
+        """Returns a dictionary of all reports, as stored in LinkReport."""
+        return {
+            'orphans': self.get_orphans(),
+            'wanted': self.get_wanted(),
+            'dead': self.get_dead_links(),
+            'important': self.get_important(),
+        }
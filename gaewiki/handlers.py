@@ -1,20 +1,26 @@
 # encoding=utf-8
 
+import datetime
+import email.utils
+import hashlib
 import logging
 import os
+import time
 import traceback
 import urllib
 
 from django.utils import simplejson
-from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.api import users
 from google.appengine.ext import blobstore
+from google.appengine.ext import db
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import blobstore_handlers
 from google.appengine.runtime.apiproxy_errors import OverQuotaError
 
 import access
+import cache
+import graph
 import images
 import model
 import settings
@@ -91,16 +97,140 @@ class RequestHandler(webapp.RequestHandler):
         return os.environ.get("HTTP_X_REQUESTED_WITH") == "XMLHttpRequest"
 
     def get_memcache(self):
-        """memcache is active only anonymous user."""
-        content = None
-        user = users.get_current_user()
-        if not user:
-            content = memcache.get(self.get_memcache_key())
-        if not content:
+        """Returns the content, cached for anonymous users, see
+        get_cached_response()."""
+        return self.get_response_content(self.get_cached_response())
+
+    @staticmethod
+    def get_response_content(response):
+        if 'content' not in response:
+            return cache.gzip_decompress(response['gzip'])
+        return response['content']
+
+    def get_cached_response(self):
+        """Returns a dictionary with the content and the time when it was
+        rendered (modified), stale copies are marked with stale=True.
+        memcache is used for anonymous users only.  Content is cached under a
+        versioned key, see get_versioned_memcache_key().  On a miss only one
+        request (the lease holder) renders the content, others wait for it
+        or, with the cache-stale-while-revalidate setting, get the last
+        cached version.  With the cache-gzip setting text is stored
+        compressed (gzip) instead of content, which lets bigger pages fit in
+        memcache."""
+        if users.get_current_user():
+            return {'content': self.get_content()}
+
+        key = self.get_versioned_memcache_key()
+        response = cache.get_large(key)
+        if isinstance(response, dict):
+            return response
+
+        stale_key = 'Stale:' + self.get_memcache_key()
+        serve_stale = settings.get('cache-stale-while-revalidate') == 'yes'
+        has_lease = cache.acquire_lease(key)
+        if not has_lease:
+            if serve_stale:
+                response = cache.get_large(stale_key)
+                if isinstance(response, dict):
+                    logging.debug(u'Serving stale content for %s' % key)
+                    return dict(response, stale=True)
+            response = cache.wait_for_value(key)
+            if isinstance(response, dict):
+                return response
+            logging.warning(u'Got no value for %s from the lease holder, rendering it again.' % key)
+
+        try:
+            response = {'modified': time.time()}
             content = self.get_content()
-            if not user:
-                memcache.set(self.get_memcache_key(), content)
-        return content
+            if settings.get('cache-gzip') == 'yes' and isinstance(content, basestring):
+                response['gzip'] = cache.gzip_compress(content)
+            else:
+                response['content'] = content
+            cache.set_large(key, response)
+            if serve_stale:
+                cache.set_large(stale_key, response)
+        except Exception:
+            if has_lease:
+                cache.mark_failed(key)
+            raise
+        finally:
+            if has_lease:
+                cache.release_lease(key)
+        return response
+
+    def reply_cached(self, content_type):
+        """Replies with the content from get_cached_response() and validators
+        for conditional requests.  If the client has the current version,
+        replies with 304 Not Modified without rendering anything."""
+        etag = self.get_etag()
+        if self.has_etag(etag):
+            self.reply_not_modified(etag)
+            return
+
+        response = self.get_cached_response()
+        if response.get('stale'):
+            # The tag is that of the current version, a stale copy has none.
+            etag = None
+        else:
+            self.response.headers['ETag'] = etag
+        modified = response.get('modified')
+        if modified is not None:
+            self.response.headers['Last-Modified'] = email.utils.formatdate(modified, usegmt=True)
+            if not self.request.headers.get('If-None-Match') and self.is_not_modified_since(modified):
+                self.reply_not_modified(etag)
+                return
+        # The python27 runtime drops Content-Encoding set by the app, the
+        # frontend compresses responses for clients that accept it.
+        self.reply(self.get_response_content(response), content_type)
+
+    def reply_not_modified(self, etag):
+        self.response.set_status(304)
+        if etag is not None:
+            self.response.headers['ETag'] = etag
+
+    def get_etag(self):
+        """Returns the entity tag of the response: a hash of the versioned
+        memcache key, which changes whenever the content can change (edits
+        bump the page counters before the editor is redirected), and of the
+        user, because logged in users see different pages."""
+        seed = self.get_versioned_memcache_key()
+        user = users.get_current_user()
+        if user is not None:
+            seed += u'|%s|%s' % (user.email(), users.is_current_user_admin())
+        return '"%s"' % hashlib.md5(seed.encode('utf-8')).hexdigest()
+
+    def has_etag(self, etag):
+        """Returns True if the If-None-Match header lists the entity tag."""
+        header = self.request.headers.get('If-None-Match')
+        if not header:
+            return False
+        tags = [tag.strip() for tag in header.split(',')]
+        return '*' in tags or etag in tags or 'W/' + etag in tags
+
+    def is_not_modified_since(self, modified):
+        """Returns True if the If-Modified-Since header is not older than the
+        time when the content was rendered."""
+        header = self.request.headers.get('If-Modified-Since')
+        if not header:
+            return False
+        parsed = email.utils.parsedate_tz(header.split(';')[0])
+        if parsed is None:
+            return False
+        return email.utils.mktime_tz(parsed) >= int(modified)
+
+    def get_memcache_generations(self):
+        """Returns names of generation counters that the cached content
+        depends on, in addition to the global one."""
+        return []
+
+    def get_versioned_memcache_key(self):
+        """Returns the memcache key with the values of the generation counters
+        folded in, so that bumping a counter invalidates all content that
+        depends on it.  Bumping the global counter purges everything."""
+        names = ['global'] + self.get_memcache_generations()
+        # Read the links counter too, wikify_filter() needs it on a miss.
+        generations = cache.get_generations(names + ['links'])
+        return u'%s@%s' % (self.get_memcache_key(), u'.'.join([str(generations[name]) for name in names]))
 
 
 class PageHandler(RequestHandler):
@@ -124,7 +254,7 @@ class PageHandler(RequestHandler):
             content_type = str(body.get("content-type", "text/plain"))
             self.reply(body["text"], content_type=content_type)
         else:
-            self.reply(self.get_memcache(), 'text/html')
+            self.reply_cached('text/html')
 
     def get_memcache_key(self):
         if self.raw:
@@ -134,6 +264,15 @@ class PageHandler(RequestHandler):
         else:
             return 'Page:' + self.title
 
+    def get_memcache_generations(self):
+        names = [u'page:' + self.title]
+        page = model.WikiContent.get_by_title(self.title)
+        if page.redirect:
+            names.append(u'page:' + page.redirect.replace('_', ' '))
+        if self.title.startswith('Label:'):
+            names.append(u'label:' + self.title[6:])
+        return names
+
     def get_content(self):
         page = model.WikiContent.get_by_title(self.title)
         if self.raw:
@@ -143,10 +282,10 @@ class PageHandler(RequestHandler):
                 revision = model.WikiRevision.get_by_key(self.request.get("r"))
                 if revision is None:
                     raise NotFound("No such revision.")
-                page.body = revision.revision_body
+                page.body = revision.get_body()
                 page.author = revision.author
                 page.updated = revision.created
-            return view.view_page(page, user=users.get_current_user(), is_admin=users.is_current_user_admin(), revision=self.revision)
+            return view.view_page(page, user=users.get_current_user(), is_admin=users.is_current_user_admin(), revision=self.revision, body_key=u'Body:' + self.get_versioned_memcache_key())
 
 
 class StartPageHandler(PageHandler):
@@ -162,13 +301,13 @@ class EditHandler(RequestHandler):
         self.edit_page(title)
 
     def edit_page(self, title, body=None):
-        page = model.WikiContent.get_by_title(title)
-        if body:
-            page.body = body
         user = users.get_current_user()
         is_admin = users.is_current_user_admin()
         if not access.can_edit_page(title, user, is_admin):
             raise Forbidden
+        page = model.WikiContent.get_by_title(title)
+        if body:
+            page.body = body
         if not body and not page.is_saved():
             page.load_template(user, is_admin)
         self.reply(view.edit_page(page), 'text/html')
@@ -183,53 +322,404 @@ class EditHandler(RequestHandler):
         if not access.can_edit_page(title, user, users.is_current_user_admin()):
             raise Forbidden
         page = model.WikiContent.get_by_title(title)
-        page.update(body=self.request.get('body'), author=user, delete=self.request.get('delete'))
+        old_title = page.title
+        old_labels = list(page.labels)
+        old_links = list(page.links)
+        existed = page.is_saved()
+        delete = self.request.get('delete')
+        page.update(body=self.request.get('body'), author=user, delete=delete)
+        # The editor is redirected to the page, which must not come from the
+        # cache, so the page counters are bumped now, the rest is left to the
+        # purge task.
+        cache.bump_generations([u'page:' + title.replace('_', ' ') for title in set([old_title, page.title])])
         self.redirect('/' + urllib.quote(page.title.encode('utf-8').replace(' ', '_')))
-        taskqueue.add(url="/w/cache/purge", params={})
+        taskqueue.add(url=SitemapUpdateHandler.url, params={
+            'page': list(set([old_title, page.title])),
+        })
+        taskqueue.add(url=CachePurgeHandler.url, params={
+            'page': list(set([old_title, page.title])),
+            'label': list(set(old_labels + page.labels)),
+            'link': list(set(old_links) ^ set(page.links)),
+            'links': 'yes' if not existed or delete or old_title != page.title else 'no',
+        })
+
+
+def is_task_request(request):
+    """Returns True if the request was sent by the task queue or by an
+    admin.  App Engine strips X-AppEngine headers from outside requests, so
+    the queue name header can't be forged."""
+    return bool(request.headers.get('X-AppEngine-QueueName')) or users.is_current_user_admin()
 
 
 class CachePurgeHandler(webapp.RequestHandler):
+    """Invalidates cached pages after an edit by bumping generation counters
+    (see RequestHandler.get_versioned_memcache_key).  The task gets the edited
+    titles, the page labels and links (before and after the edit) and whether
+    the page was created, renamed or deleted, which changes how other pages
+    link to it.  Only the affected counters are bumped, unless the change is
+    visible on every page (settings, sidebar, footer).  Without arguments
+    everything is purged by bumping the global counter."""
+    url = '/w/cache/purge'
+
+    def get(self):
+        if users.is_current_user_admin():
+            taskqueue.add(url=self.url, params={})
+
+    def post(self):
+        if not is_task_request(self.request):
+            self.error(403)
+            return
+        titles = self.request.get_all('page')
+        labels = self.request.get_all('label')
+        links_changed = self.request.get('links') == 'yes'
+        if not titles or self.is_shown_everywhere(titles, labels, links_changed):
+            cache.bump_generation('global')
+            return
+
+        # The linked pages are bumped for their backlinks lists.
+        affected = set(titles + self.request.get_all('link'))
+        if links_changed:
+            for title in titles:
+                affected.update(model.WikiContent.find_backlink_titles(title))
+        for label in labels:
+            affected.update(model.WikiContent.find_list_backlink_titles(self.get_list_link(label)))
+            if label.startswith('gaewiki:parent:'):
+                # The parent can list children with [[ListChildren:]].
+                affected.add(label[15:])
+
+        names = ['index']
+        names.extend([u'label:' + label for label in labels])
+        names.extend([u'page:' + title for title in affected])
+        cache.bump_generations(names)
+
+    def is_shown_everywhere(self, titles, labels, links_changed):
+        """Returns True if the edit affects the settings, the sidebar or the
+        footer, which are a part of every page."""
+        fragment_titles = [settings.get('sidebar', 'gaewiki:sidebar'), settings.get('footer', 'gaewiki:footer')]
+        for title in titles:
+            if title in fragment_titles or title == settings.SETTINGS_PAGE_NAME:
+                return True
+
+        fragment_links = []
+        for page in model.WikiContent.get_by_titles(fragment_titles).values():
+            fragment_links.extend(page.links)
+        if links_changed and [title for title in titles if title in fragment_links]:
+            return True
+        # List links can have options after a semicolon.
+        list_links = [link.split(';', 1)[0] for link in fragment_links]
+        for label in labels:
+            if self.get_list_link(label) in list_links:
+                return True
+        return False
+
+    @staticmethod
+    def get_list_link(label):
+        """Returns the link that lists pages with the label."""
+        if label.startswith('gaewiki:parent:'):
+            return 'ListChildren:' + label[15:]
+        return 'List:' + label
+
+
+class PageWalkTaskHandler(webapp.RequestHandler):
+    """Base class for background jobs that process every page.  A GET request
+    from an admin starts the job, each POST processes one batch and schedules
+    the next one with the query cursor, so no single request has to walk the
+    whole wiki.  Subclasses set url and define process_batch(items), which
+    gets the items of one batch.  Parameters of the first task (see get_start_params) are
+    passed on to the next ones in self.params, which batches can update,
+    self.batch is the number of the batch.  Only the task queue and admins
+    can run batches."""
+    url = None
+    batch_size = 100
+
     def get(self):
         if users.is_current_user_admin():
-            taskqueue.add(url="/w/cache/purge", params={})
+            self.start()
+
+    def start(self):
+        taskqueue.add(url=self.url, params=self.get_start_params())
+
+    def get_start_params(self):
+        return {}
 
     def post(self):
-        memcache.delete('Index:')
-        memcache.delete('IndexFeed:')
-        memcache.delete('Sitemap:')
-        memcache.delete('Changes:')
-        memcache.delete('ChangesFeed:')
-        for page in model.WikiContent.all():
-            memcache.delete('Page:' + page.title)
-            memcache.delete('RawPage:' + page.title)
-            memcache.delete('PageHistory:' + page.title)
-            memcache.delete('BackLinks:' + page.title)
-            for label in page.labels:
-                memcache.delete('PagesFeed:' + label)
-                memcache.delete('GeotaggedPagesFeed:' + label)
-                memcache.delete('GeotaggedPagesJson:' + label)
+        if not is_task_request(self.request):
+            self.error(403)
+            return
+        query = self.get_query()
+        cursor = self.request.get('cursor')
+        if cursor:
+            query.with_cursor(cursor)
+        self.batch = int(self.request.get('batch') or 0)
+        self.params = dict([(name, self.request.get(name)) for name in self.request.arguments()])
+        items = query.fetch(self.batch_size)
+        self.process_batch(items)
+        if len(items) == self.batch_size:
+            self.params.update({'cursor': query.cursor(), 'batch': self.batch + 1})
+            taskqueue.add(url=self.url, params=self.params)
+        else:
+            self.finish()
+
+    def get_query(self):
+        return model.WikiContent.all()
+
+    def finish(self):
+        pass
+
+
+class TitleKeyMigrationHandler(PageWalkTaskHandler):
+    """Moves pages stored with numeric ids to title based keys.  When done,
+    switches off the legacy title queries (the title-keys setting), unless
+    some pages couldn't be moved."""
+    url = '/w/migrate/title-keys'
+
+    def process_batch(self, pages):
+        for page in pages:
+            if page.key().name() == page.get_key_name(page.title):
+                continue
+            other = model.WikiContent.get_by_key_name(page.get_key_name(page.title))
+            if other is not None:
+                logging.warning(u'Page "%s" exists twice, not moving %s.' % (page.title, page.key()))
+                self.params['skipped'] = int(self.params.get('skipped') or 0) + 1
+                continue
+            page.rekey()
+
+    def finish(self):
+        if self.params.get('skipped'):
+            logging.warning(u'%s pages were not moved, keeping the legacy title queries.' % self.params['skipped'])
+            return
+        settings.change({'title-keys': 'yes'})
+
+
+class SitemapBuildHandler(PageWalkTaskHandler):
+    """Builds the sitemap shards from scratch, one shard per batch.  Links
+    use the base-url setting, tasks can run on a different host name."""
+    url = '/w/sitemap/build'
+    batch_size = model.SitemapShard.SIZE
+
+    def get_query(self):
+        return model.WikiContent.get_sitemap_query()
+
+    def process_batch(self, pages):
+        self.page_count = len(pages)
+        if not pages:
+            return
+        model.SitemapShard(key_name=model.SitemapShard.get_key_name(self.batch),
+                           number=self.batch,
+                           first_title=self.batch and pages[0].title or u'',
+                           page_count=len(pages),
+                           xml=view.get_sitemap_shard(pages)).put()
+
+    def finish(self):
+        # The last batch is empty when the number of pages is a multiple of
+        # the batch size, its number is then the first one to delete.
+        if self.page_count:
+            model.SitemapShard.delete_from(self.batch + 1)
+        else:
+            model.SitemapShard.delete_from(self.batch)
+        cache.bump_generation('sitemap')
+
+
+class SitemapUpdateHandler(webapp.RequestHandler):
+    """Rebuilds sitemap shards that contain the edited pages (the page
+    parameter, old and new titles).  Starts a full build when a shard gets
+    twice as big as the build makes them."""
+    url = '/w/sitemap/update'
+
+    def post(self):
+        if not is_task_request(self.request):
+            self.error(403)
+            return
+        shards = {}
+        for title in self.request.get_all('page'):
+            shard = model.SitemapShard.find_by_title(title)
+            if shard is not None:
+                shards[shard.number] = shard
+        if not shards:
+            return
+
+        limit = model.SitemapShard.SIZE * 2
+        for shard in shards.values():
+            pages = shard.get_pages_query().fetch(limit)
+            shard.page_count = len(pages)
+            shard.xml = view.get_sitemap_shard(pages)
+        db.put(shards.values())
+        cache.bump_generation('sitemap')
+
+        if [shard for shard in shards.values() if shard.page_count == limit]:
+            logging.info('Sitemap shards are too big, rebuilding the sitemap.')
+            taskqueue.add(url=SitemapBuildHandler.url)
+
+
+class RevisionCompactionHandler(PageWalkTaskHandler):
+    """Compresses old revisions of every page, see WikiRevision.compact()."""
+    url = '/w/migrate/revisions'
+    batch_size = 10
+
+    def get_query(self):
+        return model.WikiContent.get_listing_query(('title', ))
+
+    def process_batch(self, pages):
+        for page in pages:
+            count = model.WikiRevision.compact(page.title)
+            if count:
+                logging.info(u'Compressed %u revisions of page "%s".' % (count, page.title))
+
+
+class MetadataMigrationHandler(PageWalkTaskHandler):
+    """Stores header properties of pages saved before WikiContent had them,
+    see WikiContent.update_metadata()."""
+    url = '/w/migrate/metadata'
+
+    def process_batch(self, pages):
+        changed = [page for page in pages if page.locked is None]
+        for page in changed:
+            page.update_metadata()
+        if changed:
+            db.put(changed)
+
+
+class BackLinkUpdateHandler(webapp.RequestHandler):
+    """Updates backlinks of pages with many changed links, see
+    BackLinks.update()."""
+    url = model.BackLinks.UPDATE_URL
+
+    def post(self):
+        if not is_task_request(self.request):
+            self.error(403)
+            return
+        model.BackLinks.sync(self.request.get_all('title'), self.request.get_all('link'))
+
+
+class BackLinkIndexHandler(PageWalkTaskHandler):
+    """Adds pages saved before the backlink index existed to it, then
+    switches backlink lookups to the index (the backlink-index setting), see
+    BackLinks."""
+    url = '/w/migrate/backlinks'
+    batch_size = 50
+
+    def process_batch(self, pages):
+        backlinks = {}
+        for page in pages:
+            for link in set(page.links):
+                backlinks.setdefault(link, []).append(page.title)
+        model.BackLinks.add_many(backlinks)
+
+    def finish(self):
+        settings.change({'backlink-index': 'yes'})
+
+
+class LinkReportBuildHandler(PageWalkTaskHandler):
+    """Builds the link graph reports, see graph.LinkGraph.  Each batch saves
+    titles and links of its pages, the last one builds the graph from the
+    saved parts and stores the reports."""
+    url = '/w/reports/build'
+    batch_size = 200
+
+    def process_batch(self, pages):
+        model.LinkGraphPart.save(self.batch, pages)
+
+    def finish(self):
+        interwikis = [name for name, url in settings.get_interwikis()]
+        links = graph.LinkGraph(util.SPECIAL_LINK_PREFIXES + tuple(interwikis))
+        for title, page_links in model.LinkGraphPart.load(self.batch + 1):
+            links.add_page(title, page_links)
+        page_count = len(links.get_pages())
+        for name, report in links.get_reports().items():
+            model.LinkReport.save(name, report, page_count)
+        model.LinkGraphPart.delete_all()
+        cache.bump_generation('reports')
+        logging.info(u'Link reports built for %u pages.' % page_count)
+
+
+class LinkReportHandler(RequestHandler):
+    """Shows a link graph report, or the list of reports."""
+    def get(self, name):
+        self.check_open_wiki()
+        if name and name not in model.LinkReport.NAMES:
+            raise NotFound('No such report.')
+        self.name = name
+        self.reply_cached('text/html')
+
+    def get_memcache_key(self):
+        return 'LinkReport:' + self.name
+
+    def get_memcache_generations(self):
+        return ['reports']
+
+    def get_content(self):
+        if not self.name:
+            return view.show_link_report(self.name)
+        report, info = model.LinkReport.load(self.name)
+        return view.show_link_report(self.name, report, info)
+
+
+class SearchIndexHandler(PageWalkTaskHandler):
+    """Indexes pages saved before the full text search was added, see
+    SearchEntry."""
+    url = '/w/migrate/search'
+    batch_size = 50
+
+    def process_batch(self, pages):
+        db.put([model.SearchEntry.from_page(page) for page in pages])
+        cache.bump_generation('search')
+
+
+class SearchHandler(RequestHandler):
+    """Finds pages by words, see SearchEntry.search().  Results depend on
+    the user's access, so they aren't cached."""
+    def get(self):
+        query = self.request.get('q')
+        try:
+            start = int(self.request.get('cursor') or 0)
+        except ValueError:
+            raise BadRequest
+        user = users.get_current_user()
+        is_admin = users.is_current_user_admin()
+        pages, cursor = model.SearchEntry.search(query, lambda title: access.can_read_page(title, user, is_admin), start)
+        next_url = cursor and '/w/search?q=%s&cursor=%u' % (urllib.quote(query.encode('utf-8')), cursor)
+        self.reply(view.show_search_results(query, pages, next_url), 'text/html')
 
 
 class IndexHandler(RequestHandler):
+    """Lists all pages, or pages with the label, in batches.  The cursor
+    parameter selects the batch."""
     def get(self):
         self.check_open_wiki()
-        self.reply(self.get_memcache(), 'text/html')
+        self.label = self.request.get('label')
+        self.cursor = self.request.get('cursor')
+        self.by_date = self.request.get('sort') == 'date'
+        self.reply_cached('text/html')
 
     def get_memcache_key(self):
-        return 'Index:'
+        return u'Index:%s:%s:%s' % (self.label, self.by_date and 'date' or 'title', self.cursor)
+
+    def get_memcache_generations(self):
+        if self.label:
+            return [u'label:' + self.label]
+        return ['index']
 
     def get_content(self):
-        return view.list_pages(model.WikiContent.get_all())
+        if self.label:
+            pages, cursor = model.WikiContent.get_label_page(self.label, self.cursor, by_date=self.by_date)
+            next_url = cursor and util.get_label_index_url(self.label, cursor, self.by_date)
+        else:
+            pages, cursor = model.WikiContent.get_index(self.cursor)
+            next_url = cursor and '/w/index?cursor=' + urllib.quote(cursor)
+        return view.list_pages(pages, label=self.label, next_url=next_url)
 
 
 class IndexFeedHandler(RequestHandler):
     def get(self):
         self.check_open_wiki()
-        self.reply(self.get_memcache(), 'application/atom+xml')
+        self.reply_cached('application/atom+xml')
 
     def get_memcache_key(self):
         return 'IndexFeed:'
 
+    def get_memcache_generations(self):
+        return ['index']
+
     def get_content(self):
         return view.list_pages_feed(model.WikiContent.get_recently_added())
 
@@ -238,11 +728,14 @@ class PagesFeedHandler(RequestHandler):
     def get(self):
         self.check_open_wiki()
         self.label = self.request.get('label')
-        self.reply(self.get_memcache(), 'application/atom+xml')
+        self.reply_cached('application/atom+xml')
 
     def get_memcache_key(self):
         return 'PagesFeed:' + self.label
 
+    def get_memcache_generations(self):
+        return [u'label:' + self.label]
+
     def get_content(self):
         return view.list_pages_feed(model.WikiContent.get_recent_by_label(self.label))
 
@@ -250,16 +743,60 @@ class PagesFeedHandler(RequestHandler):
 class PageHistoryHandler(RequestHandler):
     def get(self):
         self.title = self.request.get('page')
+        self.cursor = self.request.get('cursor')
         if not access.can_read_page(self.title, users.get_current_user(), users.is_current_user_admin()):
             raise Forbidden
-        self.reply(self.get_memcache(), 'text/html')
+        self.reply_cached('text/html')
 
     def get_memcache_key(self):
-        return 'PageHistory:' + self.title
+        return u'PageHistory:%s:%s' % (self.title, self.cursor)
+
+    def get_memcache_generations(self):
+        return [u'page:' + self.title]
 
     def get_content(self):
         page = model.WikiContent.get_by_title(self.title)
-        return view.show_page_history(page, user=users.get_current_user(), is_admin=users.is_current_user_admin())
+        return view.show_page_history(page, user=users.get_current_user(), is_admin=users.is_current_user_admin(), cursor=self.cursor)
+
+
+class DiffHandler(RequestHandler):
+    """Shows differences between two revisions of a page (the from and to
+    parameters are revision keys), or between a revision and the current
+    version if there's no to."""
+    def get(self):
+        self.title = self.request.get('page').replace('_', ' ')
+        self.old_key = self.request.get('from')
+        self.new_key = self.request.get('to')
+        if not self.title or not self.old_key:
+            raise BadRequest
+        if not access.can_read_page(self.title, users.get_current_user(), users.is_current_user_admin()):
+            raise Forbidden
+        self.reply_cached('text/html')
+
+    def get_memcache_key(self):
+        return u'Diff:%s:%s:%s' % (self.title, self.old_key, self.new_key)
+
+    def get_memcache_generations(self):
+        if self.new_key:
+            return []
+        return [u'page:' + self.title]
+
+    def get_content(self):
+        page = model.WikiContent.get_by_title(self.title)
+        old = self.get_revision(self.old_key)
+        new = self.new_key and self.get_revision(self.new_key) or None
+        return view.show_diff(page, old, new, user=users.get_current_user(), is_admin=users.is_current_user_admin())
+
+    def get_revision(self, key):
+        """Returns a revision of the page, the title is checked so that
+        access checks can't be bypassed."""
+        try:
+            revision = model.WikiRevision.get_by_key(key)
+        except (db.BadKeyError, db.KindError):
+            revision = None
+        if not isinstance(revision, model.WikiRevision) or revision.title.replace('_', ' ') != self.title:
+            raise NotFound('No such revision.')
+        return revision
 
 
 class RobotsHandler(RequestHandler):
@@ -272,41 +809,89 @@ class RobotsHandler(RequestHandler):
 
 
 class SitemapHandler(RequestHandler):
+    """Serves the sitemap index which lists the sitemap shards.  Until the
+    shards are built serves a sitemap of the first pages and starts the
+    build."""
     def get(self):
         self.check_open_wiki()
-        self.reply(self.get_memcache(), 'text/xml')
+        self.reply_cached('text/xml')
 
     def get_memcache_key(self):
         return 'Sitemap:'
 
+    def get_memcache_generations(self):
+        return ['sitemap']
+
     def get_content(self):
+        shards = model.SitemapShard.get_list()
+        if shards:
+            return view.get_sitemap_index(shards)
+        if cache.acquire_lease('SitemapBuild', 600):
+            SitemapBuildHandler().start()
         return view.get_sitemap(model.WikiContent.get_publicly_readable())
 
 
+class SitemapShardHandler(RequestHandler):
+    def get(self, number):
+        self.check_open_wiki()
+        self.number = int(number)
+        self.reply_cached('text/xml')
+
+    def get_memcache_key(self):
+        return 'SitemapShard:%u' % self.number
+
+    def get_memcache_generations(self):
+        return ['sitemap']
+
+    def get_content(self):
+        shard = model.SitemapShard.get_by_number(self.number)
+        if shard is None:
+            raise NotFound('No such sitemap.')
+        return shard.xml
+
+
 class ChangesHandler(RequestHandler):
+    """Lists recent changes from the change log.  Clients that poll for
+    changes can pass the since parameter (seconds since the epoch, UTC) to
+    only get newer changes, such responses aren't cached."""
+    content_type = 'text/html'
+
     def get(self):
         if not access.can_see_most_pages(users.get_current_user(), users.is_current_user_admin()):
             raise Forbidden
-        self.reply(self.get_memcache(), 'text/html')
+        self.since = self.get_since()
+        if self.since is None:
+            self.reply_cached(self.content_type)
+        else:
+            self.reply(self.get_content(), self.content_type)
+
+    def get_since(self):
+        since = self.request.get('since')
+        if not since:
+            return None
+        try:
+            return datetime.datetime.utcfromtimestamp(float(since))
+        except (ValueError, OverflowError):
+            raise BadRequest
 
     def get_memcache_key(self):
         return 'Changes:'
 
+    def get_memcache_generations(self):
+        return ['index']
+
     def get_content(self):
-        return view.get_change_list(model.WikiContent.get_changes())
+        return view.get_change_list(model.WikiChange.get_recent(self.since))
 
 
-class ChangesFeedHandler(RequestHandler):
-    def get(self):
-        if not access.can_see_most_pages(users.get_current_user(), users.is_current_user_admin()):
-            raise Forbidden
-        self.reply(self.get_memcache(), 'text/xml')
+class ChangesFeedHandler(ChangesHandler):
+    content_type = 'text/xml'
 
     def get_memcache_key(self):
         return 'ChangesFeed:'
 
     def get_content(self):
-        return view.get_change_feed(model.WikiContent.get_changes())
+        return view.get_change_feed(model.WikiChange.get_recent(self.since))
 
 
 class BackLinksHandler(RequestHandler):
@@ -314,14 +899,17 @@ class BackLinksHandler(RequestHandler):
         self.title = self.request.get('page')
         if not access.can_read_page(self.title, users.get_current_user(), users.is_current_user_admin()):
             raise Forbidden
-        self.reply(self.get_memcache(), 'text/html')
+        self.reply_cached('text/html')
 
     def get_memcache_key(self):
         return 'BackLinks:' + self.title
 
+    def get_memcache_generations(self):
+        return [u'page:' + self.title]
+
     def get_content(self):
         page = model.WikiContent.get_by_title(self.title)
-        return view.get_backlinks(page, page.get_backlinks())
+        return view.get_backlinks(page, sorted(model.WikiContent.find_backlink_titles(self.title)))
 
 
 class UsersHandler(RequestHandler):
@@ -396,11 +984,14 @@ class GeotaggedPagesFeedHandler(RequestHandler):
     def get(self):
         self.check_open_wiki()
         self.label = self.request.get('label', None)
-        self.reply(self.get_memcache(), 'application/atom+xml')
+        self.reply_cached('application/atom+xml')
 
     def get_memcache_key(self):
         return 'GeotaggedPagesFeed:' + self.label
 
+    def get_memcache_generations(self):
+        return [u'label:' + (self.label or model.WikiContent.GEOLABEL).replace('_', ' ')]
+
     def get_content(self):
         return view.list_pages_feed(model.WikiContent.find_geotagged(label=self.label))
 
@@ -409,11 +1000,14 @@ class GeotaggedPagesJsonHandler(RequestHandler):
     def get(self):
         self.check_open_wiki()
         self.label = self.request.get('label', None)
-        self.reply(self.get_memcache(), 'text/javascript')
+        self.reply_cached('text/javascript')
 
     def get_memcache_key(self):
         return 'GeotaggedPagesJson:' + self.label
 
+    def get_memcache_generations(self):
+        return [u'label:' + (self.label or model.WikiContent.GEOLABEL).replace('_', ' ')]
+
     def get_content(self):
         return view.show_pages_map_data(model.WikiContent.find_geotagged(label=self.label))
 
@@ -493,7 +1087,7 @@ class ImageServeHandler(RequestHandler):
         }
 
         page_title = "Image:" + img.get_key()
-        data["pages"] = model.WikiContent.find_backlinks_for(page_title)
+        data["pages"] = sorted(model.WikiContent.find_backlink_titles(page_title))
 
         html = view.view_image(data, user=users.get_current_user(),
             is_admin=users.is_current_user_admin())
@@ -502,9 +1096,9 @@ class ImageServeHandler(RequestHandler):
 
 class ImageListHandler(RequestHandler):
     def get(self):
-        lst = images.Image.find_all()
+        lst, cursor = images.Image.find_page(self.request.get('cursor'))
         html = view.view_image_list(lst, users.get_current_user(),
-            users.is_current_user_admin())
+            users.is_current_user_admin(), cursor)
         self.reply(html, "text/html")
 
 
@@ -512,10 +1106,12 @@ handlers = [
     ('/', StartPageHandler),
     ('/robots\.txt$', RobotsHandler),
     ('/sitemap\.xml$', SitemapHandler),
+    ('/sitemap-(\d+)\.xml$', SitemapShardHandler),
     ('/w/backlinks$', BackLinksHandler),
     ('/w/changes$', ChangesHandler),
     ('/w/changes\.rss$', ChangesFeedHandler),
     ('/w/data/export$', DataExportHandler),
+    ('/w/diff$', DiffHandler),
     ('/w/data/import$', DataImportHandler),
     ('/w/edit$', EditHandler),
     ('/w/history$', PageHistoryHandler),
@@ -531,8 +1127,19 @@ handlers = [
     ('/w/pages/geotagged\.js', GeotaggedPagesJsonHandler),
     ('/w/pages/map', PageMapHandler),
     ('/w/profile', ProfileHandler),
+    ('/w/reports/build$', LinkReportBuildHandler),
+    ('/w/reports/(\w*)$', LinkReportHandler),
+    ('/w/search$', SearchHandler),
     ('/w/users$', UsersHandler),
     ('/w/login', LoginHandler),
     ('/w/cache/purge$', CachePurgeHandler),
+    ('/w/migrate/title-keys$', TitleKeyMigrationHandler),
+    ('/w/migrate/metadata$', MetadataMigrationHandler),
+    ('/w/migrate/revisions$', RevisionCompactionHandler),
+    ('/w/migrate/search$', SearchIndexHandler),
+    ('/w/migrate/backlinks$', BackLinkIndexHandler),
+    ('/w/backlinks/update$', BackLinkUpdateHandler),
+    ('/w/sitemap/build$', SitemapBuildHandler),
+    ('/w/sitemap/update$', SitemapUpdateHandler),
     ('/(.+)$', PageHandler),
 ]
@@ -1,6 +1,8 @@
 from google.appengine.api.images import get_serving_url
 from google.appengine.ext import blobstore
 
+import model
+
 
 class Image(object):
     def __init__(self, blob):
@@ -15,6 +17,13 @@ class Image(object):
         all = blobstore.BlobInfo.all().fetch(limit)
         return [cls(i) for i in all]
 
+    @classmethod
+    def find_page(cls, cursor=None, limit=100):
+        """Returns a batch of images, newest first, and the next cursor."""
+        query = blobstore.BlobInfo.all().order('-creation')
+        blobs, cursor = model.fetch_page(query, cursor, limit)
+        return [cls(i) for i in blobs], cursor
+
     def get_info(self):
         """Returns a dictionary with basic image properties."""
         return {
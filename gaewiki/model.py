@@ -1,17 +1,39 @@
 # encoding=utf-8
 
 import datetime
+import hashlib
 import logging
 import random
 import re
+import zlib
 
+from google.appengine.api import taskqueue
 from google.appengine.api import users
 from google.appengine.ext import db
 
+from django.utils import simplejson
+
+import cache
+import diff
+import search
 import settings
 import util
 
 
+def fetch_page(query, cursor=None, limit=100):
+    """Returns a batch of query results and the cursor of the next batch, or
+    None if this one is the last.  Invalid cursors are ignored."""
+    if cursor:
+        try:
+            query.with_cursor(cursor)
+        except (db.BadRequestError, db.BadValueError), e:
+            logging.warning(u'Ignoring bad cursor %s: %s' % (cursor, e))
+    items = query.fetch(limit)
+    if len(items) < limit:
+        return items, None
+    return items, query.cursor()
+
+
 class WikiUser(db.Model):
     wiki_user = db.UserProperty()
     joined = db.DateTimeProperty(auto_now_add=True)
@@ -43,11 +65,14 @@ class WikiUser(db.Model):
     def get_or_create(cls, user):
         if user is None:
             return None
-        wiki_user = cls.gql('WHERE wiki_user = :1', user).get()
-        if wiki_user is None:
-            wiki_user = cls(wiki_user=user)
-            wiki_user.nickname = cls.get_unique_nickname(wiki_user)
-            wiki_user.put()
+        wiki_user = cache.request_get(('user', user.email()))
+        if wiki_user is cache.MISSING:
+            wiki_user = cls.gql('WHERE wiki_user = :1', user).get()
+            if wiki_user is None:
+                wiki_user = cls(wiki_user=user)
+                wiki_user.nickname = cls.get_unique_nickname(wiki_user)
+                wiki_user.put()
+            cache.request_set(('user', user.email()), wiki_user)
         return wiki_user
 
     @classmethod
@@ -71,9 +96,19 @@ class WikiUserReference(db.ReferenceProperty):
 
 
 class WikiContent(db.Model):
-    """Stores current versions of pages."""
+    """Stores current versions of pages.
+
+    Pages are stored under a key name derived from the title (see
+    get_key_name), so that looking a page up is a key get.  Pages created
+    before that (with numeric ids) are found with a title query until they
+    are moved to the new key by put() or by the /w/migrate/title-keys task."""
     GEOLABEL = 'gaewiki:geopt'
 
+    # Properties loaded by page lists, see get_listing_query().
+    INDEX_PROPERTIES = ('title', 'redirect')
+    SITEMAP_PROPERTIES = ('title', 'updated')
+    CHANGES_PROPERTIES = ('title', 'updated', 'author')
+
     title = db.StringProperty(required=True)
     body = db.TextProperty(required=False)
     author = WikiUserReference()
@@ -88,23 +123,56 @@ class WikiContent(db.Model):
     labels = db.StringListProperty()
     # Pages that this one links to.
     links = db.StringListProperty()
+    # Header properties stored by put(), see update_metadata().
+    display_title = db.StringProperty()
+    locked = db.BooleanProperty(indexed=False)
+    comments = db.BooleanProperty(indexed=False)
+    map_label = db.StringProperty(indexed=False)
+    file = db.TextProperty()
+    file_type = db.StringProperty(indexed=False)
+    file_length = db.StringProperty(indexed=False)
+    public = db.BooleanProperty(indexed=False)
+    private = db.BooleanProperty(indexed=False)
+    readers = db.StringListProperty(indexed=False)
+    editors = db.StringListProperty(indexed=False)
 
-    def __init__(self, *args, **kwargs):
-        super(WikiContent, self).__init__(*args, **kwargs)
+    def __init__(self, parent=None, key_name=None, _app=None, _from_entity=False, **kwargs):
+        if key_name is None and not _from_entity and 'key' not in kwargs and kwargs.get('title'):
+            key_name = self.get_key_name(kwargs['title'])
+        super(WikiContent, self).__init__(parent, key_name, _app, _from_entity, **kwargs)
         self._parsed_page = None
+        self._parsed_body = None
+        # The body that the stored header properties were taken from.
+        self._metadata_body = self.body if _from_entity else None
+
+    @staticmethod
+    def get_key_name(title):
+        """Returns the datastore key name for a page title."""
+        return u'page:' + title.replace('_', ' ')
+
+    @staticmethod
+    def has_legacy_keys():
+        """Returns True unless all pages were moved to title based keys, in
+        which case lookups that miss the key don't fall back to queries."""
+        return settings.get('title-keys') != 'yes'
+
+    def get_parsed_page(self):
+        """Returns the parsed body, parses it again if the body was changed."""
+        if self._parsed_page is None or self._parsed_body is not self.body:
+            self._parsed_page = self.parse_body(self.body or '')
+            self._parsed_body = self.body
+        return self._parsed_page
 
     def get_property(self, key, default=None):
         """Returns the value of a property."""
-        if self._parsed_page is None:
-            self._parsed_page = self.parse_body(self.body or '')
-        return self._parsed_page.get(key, default)
+        return self.get_parsed_page().get(key, default)
 
     def set_property(self, key, value):
         """Changes the value of a property."""
-        if self._parsed_page is None:
-            self._parsed_page = self.parse_body(self.body or '')
-        self._parsed_page[key] = value
-        self.body = self.format_body(self._parsed_page)
+        parsed = self.get_parsed_page()
+        parsed[key] = value
+        self.body = self.format_body(parsed)
+        self._parsed_body = self.body
 
         user = users.get_current_user()
         if user:
@@ -123,7 +191,8 @@ class WikiContent(db.Model):
     def comments_enabled(self):
         """Returns True if the page has a comments:yes property and the
         comments_code global settings is not empty."""
-        if self.get_property('comments') == ['yes']:
+        self.check_metadata()
+        if self.comments:
             return True
 
     @property
@@ -136,13 +205,22 @@ class WikiContent(db.Model):
         return data
 
     def get_display_title(self):
-        return self.get_property('display_title', self.title)
+        self.check_metadata()
+        if self.display_title is None:
+            return self.title
+        return self.display_title
+
+    def get_map_label(self):
+        self.check_metadata()
+        return self.map_label
 
     def get_file(self):
-        return self.get_property('file')
+        self.check_metadata()
+        return self.file
 
     def get_file_type(self):
-        filetype = self.get_property('file_type')
+        self.check_metadata()
+        filetype = self.file_type
         if filetype is None:
             url = self.get_file() or ''
             if url.endswith('.mp3'):
@@ -152,14 +230,19 @@ class WikiContent(db.Model):
         return filetype or 'application/octet-stream'
 
     def get_file_length(self):
-        return self.get_property('file_length')
+        self.check_metadata()
+        return self.file_length
 
     def put(self):
         """Adds the gaewiki:parent: labels transparently."""
+        old_title = self.title
+        old_labels = list(self.labels)
+        old_links = list(self.links)
+        old_display_title = self.display_title
+        is_new = not self.is_saved()
         if self.body is not None:
-            options = util.parse_page(self.body)
+            options = self.get_parsed_page()
             self.redirect = options.get('redirect')
-            self.pread = options.get('public') == 'yes' and options.get('private') != 'yes'
             self.labels = options.get('labels', [])
             if 'date' in options:
                 try:
@@ -174,9 +257,88 @@ class WikiContent(db.Model):
 
         self.links = util.extract_links(self.body)
         self.add_implicit_labels()
-        db.Model.put(self)
+        self.update_metadata()
+        if self.has_key() and self.key().name() == self.get_key_name(self.title):
+            db.Model.put(self)
+        else:
+            self.rekey()
+            self._metadata_body = self.body
+        if old_title != self.title:
+            cache.request_set(('page', old_title.replace('_', ' ')), None)
+            SearchEntry.delete_for(old_title)
+        cache.request_set(('page', self.title.replace('_', ' ')), self)
+        SearchEntry.from_page(self).put()
+        cache.bump_generation('search')
+        if old_title != self.title:
+            BackLinks.update([old_title, self.title], set(old_links) | set(self.links))
+        else:
+            BackLinks.update([self.title], set(old_links) ^ set(self.links))
+        if is_new or old_title != self.title or sorted(old_labels) != sorted(self.labels) or (self.labels and old_display_title != self.display_title):
+            # Link classes and page lists could change.
+            cache.bump_generation('links')
+            cache.flush_fragments()
         settings.check_and_flush(self)
 
+    def delete(self):
+        cache.request_set(('page', self.title.replace('_', ' ')), None)
+        cache.bump_generation('links')
+        cache.flush_fragments()
+        SearchEntry.delete_for(self.title)
+        cache.bump_generation('search')
+        BackLinks.update([self.title], self.links)
+        db.Model.delete(self)
+
+    def rekey(self):
+        """Stores the page under the key derived from its current title.  Used
+        for legacy pages and renamed pages: the page is copied to the new key,
+        the old entity is deleted and this instance is updated in place to
+        represent the new entity."""
+        values = dict([(name, prop.get_value_for_datastore(self)) for name, prop in self.properties().items()])
+        page = WikiContent(key_name=self.get_key_name(self.title), **values)
+        db.Model.put(page)
+        if self.is_saved():
+            logging.debug(u'Moving page "%s" to key %s' % (self.title, page.key().name()))
+            db.delete(self.key())
+        self.__dict__.update(page.__dict__)
+
+    def update_metadata(self):
+        """Copies header properties used by listings, templates and access
+        checks to datastore properties, so that they don't parse the body."""
+        options = self.get_parsed_page()
+        self.display_title = options.get('display_title')
+        if self.display_title is not None:
+            self.display_title = self.display_title[:500]
+        self.locked = options.get('locked') == 'yes'
+        self.comments = options.get('comments') == ['yes']
+        self.map_label = options.get('map_label')
+        self.file = options.get('file')
+        self.file_type = options.get('file_type')
+        self.file_length = options.get('file_length')
+        self.public = options.get('public') == 'yes'
+        self.private = options.get('private') == 'yes'
+        self.pread = self.public and not self.private
+        self.readers = self.get_list_property('readers')
+        self.editors = self.get_list_property('editors')
+        self._metadata_body = self.body
+
+    def has_metadata(self):
+        """Returns True if the stored header properties match the body.  That's
+        not the case for pages saved before the properties existed and for
+        pages which body was replaced (previews, old revisions)."""
+        return self.locked is not None and self._metadata_body is not None and self._metadata_body is self.body
+
+    def check_metadata(self):
+        """Makes sure that the header properties match the body."""
+        if not self.has_metadata():
+            self.update_metadata()
+
+    def get_list_property(self, key):
+        """Returns a page property as a list of non-empty strings."""
+        value = self.get_property(key, [])
+        if not isinstance(value, list):
+            value = [value]
+        return [v for v in value if v]
+
     def __update_geopt(self):
         """Updates the geopt property from the appropriate page property.
         Maintains the gaewiki:geopt label."""
@@ -204,7 +366,8 @@ class WikiContent(db.Model):
     def backup(self):
         """Archives the current page revision."""
         logging.debug(u'Backing up page "%s"' % self.title)
-        archive = WikiRevision(title=self.title, revision_body=self.body, author=self.author, created=self.updated)
+        archive = WikiRevision(title=self.title, author=self.author, created=self.updated)
+        archive.store_body(self.body or u'', WikiRevision.get_latest(self.title))
         archive.put()
 
     def update(self, body, author, delete):
@@ -213,6 +376,7 @@ class WikiContent(db.Model):
             if delete:
                 logging.debug(u'Deleting page "%s"' % self.title)
                 self.delete()
+                WikiChange.from_page(self, author=WikiUser.get_or_create(author), deleted=True).put()
                 return
 
         logging.debug(u'Updating page "%s"' % self.title)
@@ -224,10 +388,24 @@ class WikiContent(db.Model):
         # TODO: cross-link
 
         self.put()
+        WikiChange.from_page(self).put()
 
     def get_history(self):
         return WikiRevision.gql('WHERE title = :1 ORDER BY created DESC', self.title).fetch(100)
 
+    def get_history_page(self, cursor=None, limit=100):
+        """Returns a batch of revisions, newest first, and the next cursor.
+        Authors of the revisions are loaded with a single batch get."""
+        query = WikiRevision.all().filter('title =', self.title).order('-created')
+        revisions, cursor = fetch_page(query, cursor, limit)
+        keys = list(set([WikiRevision.author.get_value_for_datastore(revision) for revision in revisions]) - set([None]))
+        authors = dict(zip(keys, db.get(keys)))
+        for revision in revisions:
+            author = authors.get(WikiRevision.author.get_value_for_datastore(revision))
+            if author is not None:
+                revision.author = author
+        return revisions, cursor
+
     def get_backlinks(self):
         return self.find_backlinks_for(self.title)
 
@@ -235,6 +413,36 @@ class WikiContent(db.Model):
     def find_backlinks_for(cls, title, limit=1000):
         return WikiContent.gql('WHERE links = :1', title).fetch(limit)
 
+    @classmethod
+    def find_backlink_titles(cls, title, limit=1000):
+        """Returns titles of pages that link to the specified one.  Reads the
+        backlink index when it's complete, otherwise uses a keys only query,
+        titles are taken from key names, legacy pages are loaded."""
+        if BackLinks.is_complete():
+            return BackLinks.get_titles(title)
+        return cls.get_titles_by_keys(WikiContent.gql('WHERE links = :1', title).fetch(limit, keys_only=True))
+
+    @classmethod
+    def find_list_backlink_titles(cls, link, limit=1000):
+        """Returns titles of pages that link to a page list, with or without
+        options (e.g., List:news;sort=date)."""
+        query = WikiContent.all(keys_only=True).filter('links >', link + u';').filter('links <', link + u';\ufffd')
+        return cls.find_backlink_titles(link, limit) + cls.get_titles_by_keys(query.fetch(limit))
+
+    @staticmethod
+    def get_titles_by_keys(keys):
+        """Returns titles of pages with the keys, taken from key names, legacy
+        pages are loaded."""
+        titles = []
+        legacy = []
+        for key in keys:
+            if key.name() and key.name().startswith('page:'):
+                titles.append(key.name()[5:])
+            else:
+                legacy.append(key)
+        titles.extend([page.title for page in db.get(legacy) if page is not None])
+        return titles
+
     def load_template(self, user, is_admin):
         template = '# PAGE_TITLE\n\n**PAGE_TITLE** is ...'
         template_names = ['gaewiki:anon page template']
@@ -243,7 +451,7 @@ class WikiContent(db.Model):
         if users.is_current_user_admin():
             template_names.insert(0, 'gaewiki:admin page template')
         for template_name in template_names:
-            page = WikiContent.gql('WHERE title = :1', template_name).get()
+            page = WikiContent.get_by_title(template_name, create_if_none=False)
             if page is not None:
                 logging.debug('Loaded template from %s' % template_name)
                 template = page.body.replace(template_name, 'PAGE_TITLE')
@@ -254,7 +462,8 @@ class WikiContent(db.Model):
 
     def is_locked(self):
         """Returns True if the page has the locked:yes property."""
-        return self.get_property('locked') == 'yes'
+        self.check_metadata()
+        return self.locked
 
     def get_redirected(self):
         """Returns the page that this one redirects to (if at all)."""
@@ -269,29 +478,101 @@ class WikiContent(db.Model):
         """Finds and loads the page by its title, creates a new one if nothing
         could be found."""
         title = title.replace('_', ' ')
-        page = cls.gql('WHERE title = :1', title).get()
+        page = cache.request_get(('page', title))
+        if page is cache.MISSING:
+            page = cls.get_by_key_name(cls.get_key_name(title))
+            if page is None and cls.has_legacy_keys():
+                page = cls.gql('WHERE title = :1', title).get()
+            cache.request_set(('page', title), page)
         if page is None and create_if_none:
             page = cls(title=title)
             if default_body is not None:
                 page.body = default_body
         return page
 
+    @classmethod
+    def get_by_titles(cls, titles):
+        """Loads several pages at once, returns a dictionary that maps titles
+        to saved pages.  Titles that have no page are left out.  Pages are
+        loaded with a single batch key get, legacy pages are then looked up
+        with chunked IN queries (the datastore allows at most 30 values per IN
+        filter)."""
+        pages = {}
+        missing = []
+        for title in set([title.replace('_', ' ') for title in titles]):
+            page = cache.request_get(('page', title))
+            if page is cache.MISSING:
+                missing.append(title)
+            elif page is not None:
+                pages[title] = page
+        if not missing:
+            return pages
+
+        loaded = {}
+        for page in cls.get_by_key_name([cls.get_key_name(title) for title in missing]):
+            if page is not None:
+                loaded[page.title.replace('_', ' ')] = page
+        if cls.has_legacy_keys():
+            titles = [title for title in missing if title not in loaded]
+            for idx in range(0, len(titles), 30):
+                for page in cls.all().filter('title IN', titles[idx:idx + 30]):
+                    loaded[page.title.replace('_', ' ')] = page
+        for title in missing:
+            cache.request_set(('page', title), loaded.get(title))
+        pages.update(loaded)
+        return pages
+
     @classmethod
     def get_by_label(cls, label):
         """Returns a list of pages that have the specified label."""
         return cls.gql('WHERE labels = :1', label).fetch(100)
 
     @classmethod
-    def get_publicly_readable(cls):
-        if settings.get('open-reading') == 'yes':
-            pages = cls.all()
-        else:
-            pages = cls.gql('WHERE pread = :1', True).fetch(1000)
-        return sorted(pages, key=lambda p: p.title.lower())
+    def get_label_page(cls, label, cursor=None, limit=100, by_date=False):
+        """Returns a batch of pages with the label and the next cursor.  Pages
+        are ordered by title, or by date (newest first) with by_date=True."""
+        query = cls.all().filter('labels =', label).order(by_date and '-created' or 'title')
+        return fetch_page(query, cursor, limit)
+
+    @classmethod
+    def get_publicly_readable(cls, limit=1000):
+        """Returns titles and dates of readable pages, for the sitemap.  Pages
+        are loaded in batches while the caller iterates."""
+        return cls.get_sitemap_query().run(limit=limit, batch_size=500)
+
+    @classmethod
+    def get_sitemap_query(cls):
+        """Returns a query for titles and dates of readable pages, ordered by
+        title."""
+        query = cls.get_listing_query(cls.SITEMAP_PROPERTIES)
+        if settings.get('open-reading') != 'yes':
+            query.filter('pread =', True)
+        return query.order('title')
 
     @classmethod
     def get_all(cls):
-        return sorted(cls.all().order('title').fetch(1000), key=lambda p: p.title.lower() if ':' in p.title else ':' + p.title.lower())
+        return cls.sort_by_namespace(cls.all().order('title').fetch(1000))
+
+    @classmethod
+    def get_index(cls, cursor=None, limit=500):
+        """Returns titles of a batch of pages, for the page index, and the
+        cursor of the next batch."""
+        query = cls.get_listing_query(cls.INDEX_PROPERTIES).order('title')
+        pages, cursor = fetch_page(query, cursor, limit)
+        return cls.sort_by_namespace(pages), cursor
+
+    @staticmethod
+    def sort_by_namespace(pages):
+        """Sorts pages by title, pages without a namespace come first."""
+        return sorted(pages, key=lambda p: p.title.lower() if ':' in p.title else ':' + p.title.lower())
+
+    @classmethod
+    def get_listing_query(cls, properties):
+        """Returns a projection query which only loads the specified
+        properties, not the page bodies.  Such pages can't be saved.  Every
+        combination of properties, filters and orders needs an index, see
+        index.yaml."""
+        return db.Query(cls, projection=properties)
 
     @classmethod
     def get_recently_added(cls, limit=100):
@@ -302,12 +583,20 @@ class WikiContent(db.Model):
         return cls.gql('WHERE labels = :1 ORDER BY created DESC', label).fetch(limit)
 
     @classmethod
-    def get_changes(cls):
-        if settings.get('open-reading') in ('yes', 'login'):
-            pages = cls.all().order('-updated').fetch(20)
+    def get_changes(cls, slim=False):
+        """Returns recently changed pages.  With slim=True only loads the
+        properties shown by the change list (CHANGES_PROPERTIES)."""
+        open_reading = settings.get('open-reading') in ('yes', 'login')
+        if not slim:
+            query = cls.all()
+        elif open_reading:
+            query = cls.get_listing_query(cls.CHANGES_PROPERTIES + ('pread', ))
         else:
-            pages = cls.gql('WHERE pread = :1 ORDER BY updated DESC', True).fetch(20)
-        return pages
+            # Can't project a property used in an equality filter.
+            query = cls.get_listing_query(cls.CHANGES_PROPERTIES)
+        if not open_reading:
+            query.filter('pread =', True)
+        return query.order('-updated').fetch(20)
 
     @classmethod
     def get_error_page(cls, error_code, default_body=None):
@@ -354,13 +643,41 @@ class WikiContent(db.Model):
         return pages
 
 
+class WikiRevisionBody(db.Model):
+    """Stores the compressed text of a revision, apart from the revision so
+    that listing revisions doesn't load the texts.  Keyframes have the whole
+    text (compressed_body), other revisions the difference (delta) from
+    their keyframe, see WikiRevision.store_body()."""
+    compressed_body = db.BlobProperty()
+    delta = db.BlobProperty()
+
+
 class WikiRevision(db.Model):
     """
     Stores older revisions of pages.
+
+    The compressed text is stored in a WikiRevisionBody (data), which is
+    only loaded when the revision is opened, see get_body().  Revisions
+    saved before that have the text in revision_body, or the compressed
+    text in compressed_body and delta; the /w/migrate/revisions task moves
+    it to WikiRevisionBody.
     """
+    # Revisions between keyframes.
+    KEYFRAME_INTERVAL = 20
+
     title = db.StringProperty()
     wiki_page = db.ReferenceProperty(WikiContent)
-    revision_body = db.TextProperty(required=True)
+    revision_body = db.TextProperty()
+    compressed_body = db.BlobProperty()
+    delta = db.BlobProperty()
+    data = db.ReferenceProperty(WikiRevisionBody)
+    # The keyframe that the delta applies to, None for keyframes.
+    base = db.SelfReferenceProperty(collection_name='delta_set')
+    # The number of revisions since the keyframe.
+    depth = db.IntegerProperty(indexed=False, default=0)
+    # Length of the text and its change since the previous revision.
+    size = db.IntegerProperty(indexed=False)
+    size_change = db.IntegerProperty(indexed=False)
     author = db.ReferenceProperty(WikiUser)
     created = db.DateTimeProperty(auto_now_add=True)
     pread = db.BooleanProperty()
@@ -368,3 +685,463 @@ class WikiRevision(db.Model):
     @classmethod
     def get_by_key(cls, key):
         return db.Model.get(db.Key(key))
+
+    @classmethod
+    def get_latest(cls, title):
+        return cls.all().filter('title =', title).order('-created').get()
+
+    def is_keyframe(self):
+        return WikiRevision.base.get_value_for_datastore(self) is None
+
+    def get_keyframe(self):
+        if self.is_keyframe():
+            return self
+        return self.base
+
+    def get_size_change(self):
+        """Returns the change of the text length, e.g. "+12", or an empty
+        string if it's not known."""
+        if self.size_change is None:
+            return u''
+        return u'%+d' % self.size_change
+
+    def get_data(self):
+        """Returns the entity with the compressed text: the revision itself
+        if it was compressed before WikiRevisionBody existed."""
+        if self.compressed_body is not None or self.delta is not None:
+            return self
+        return self.data
+
+    def get_body(self):
+        """Returns the text of the revision."""
+        if self.revision_body is not None:
+            return self.revision_body
+        data = self.get_data()
+        if self.is_keyframe():
+            return zlib.decompress(data.compressed_body).decode('utf-8')
+        return diff.apply_delta(self.base.get_body(), data.delta)
+
+    def store_body(self, body, previous=None):
+        """Saves the compressed body in a new WikiRevisionBody, the caller
+        saves the revision.  If there's a previous revision, and the keyframe
+        isn't too old, only the difference from the keyframe is stored,
+        unless it's not much smaller than the whole text."""
+        compressed = zlib.compress(body.encode('utf-8'))
+        data = WikiRevisionBody(compressed_body=db.Blob(compressed))
+        self.base = None
+        self.depth = 0
+        if previous is not None and previous.depth < self.KEYFRAME_INTERVAL:
+            keyframe = previous.get_keyframe()
+            delta = diff.make_delta(keyframe.get_body(), body)
+            if len(delta) < len(compressed) / 2:
+                data = WikiRevisionBody(delta=db.Blob(delta))
+                self.base = keyframe
+                self.depth = previous.depth + 1
+        data.put()
+        self.data = data
+        self.revision_body = self.compressed_body = self.delta = None
+        self.size = len(body)
+        if previous is not None and previous.size is not None:
+            self.size_change = self.size - previous.size
+
+    @classmethod
+    def compact(cls, title, batch_size=10):
+        """Compresses revisions of the page saved before revisions were
+        compressed and moves compressed texts stored in revisions to
+        WikiRevisionBody.  Returns the number of changed revisions."""
+        previous = None
+        changed = []
+        count = 0
+        for revision in cls.all().filter('title =', title).order('created'):
+            if revision.revision_body is not None:
+                revision.store_body(revision.revision_body, previous)
+                changed.append(revision)
+            elif revision.compressed_body is not None or revision.delta is not None:
+                data = WikiRevisionBody(compressed_body=revision.compressed_body, delta=revision.delta)
+                data.put()
+                revision.data = data
+                revision.compressed_body = revision.delta = None
+                changed.append(revision)
+            if len(changed) == batch_size:
+                db.put(changed)
+                count += len(changed)
+                changed = []
+            previous = revision
+        db.put(changed)
+        return count + len(changed)
+
+
+class WikiChange(db.Model):
+    """Stores an entry of the change log, written by WikiContent.update().
+    Has everything that the change list and the feed show, including the
+    rendered summary, so listing changes is a single small query."""
+    title = db.StringProperty(required=True)
+    display_title = db.StringProperty(indexed=False)
+    author = db.ReferenceProperty(WikiUser)
+    author_name = db.StringProperty(indexed=False)
+    author_email = db.StringProperty(indexed=False)
+    created = db.DateTimeProperty()
+    pread = db.BooleanProperty()
+    deleted = db.BooleanProperty(indexed=False, default=False)
+    summary = db.TextProperty()
+
+    @classmethod
+    def from_page(cls, page, author=None, deleted=False):
+        """Describes the current state of the page.  Pages loaded by listing
+        queries have no body and get no summary, neither do pages with
+        restricted access, because the feed is readable by everyone who can
+        see the list of pages."""
+        if author is None:
+            author = page.author
+        change = cls(title=page.title,
+                     display_title=page.display_title,
+                     author=author,
+                     created=deleted and datetime.datetime.now() or page.updated,
+                     pread=page.pread,
+                     deleted=deleted)
+        if author is not None:
+            change.author_name = author.get_nickname()
+            change.author_email = author.get_public_email()
+        if page.body is not None and not deleted and not page.private and not page.readers:
+            change.summary = page.summary
+        return change
+
+    def get_display_title(self):
+        return self.display_title or self.title
+
+    @classmethod
+    def get_recent(cls, since=None, limit=20):
+        """Returns the latest changes, newest first.  With since (a datetime)
+        only returns changes made after that time.  Until the log has any
+        entries, describes recently changed pages instead."""
+        query = cls.all()
+        if settings.get('open-reading') not in ('yes', 'login'):
+            query.filter('pread =', True)
+        if since is not None:
+            query.filter('created >', since)
+        changes = query.order('-created').fetch(limit)
+        if not changes and since is None and cls.all(keys_only=True).get() is None:
+            changes = [cls.from_page(page) for page in WikiContent.get_changes(slim=True)]
+        return changes
+
+
+class BackLinks(db.Model):
+    """Titles of pages that link to a page, stored under the key name of the
+    linked page (which doesn't have to exist).  WikiContent.put() and
+    delete() update the entries that their links were added to or removed
+    from, so reading backlinks takes a single key lookup instead of a query
+    that loads every linking page.  The index is used when the
+    /w/migrate/backlinks task has indexed pages saved before it existed
+    (the backlink-index setting)."""
+    # Entries updated by the request that saves a page, more are left to a
+    # task (see update()), each entry takes a transaction.
+    MAX_INLINE_UPDATES = 20
+    UPDATE_URL = '/w/backlinks/update'
+
+    titles = db.StringListProperty(indexed=False)
+    # The number of titles, for finding the most linked pages.
+    count = db.IntegerProperty(default=0)
+
+    @staticmethod
+    def is_complete():
+        return settings.get('backlink-index') == 'yes'
+
+    @classmethod
+    def get_titles(cls, title):
+        entry = cls.get_by_key_name(WikiContent.get_key_name(title))
+        if entry is None:
+            return []
+        return entry.titles
+
+    @classmethod
+    def get_most_linked(cls, limit=100):
+        """Returns (title, count) tuples for pages with most backlinks."""
+        query = db.Query(cls, projection=('count', )).order('-count')
+        return [(entry.key().name()[5:], entry.count) for entry in query.fetch(limit)]
+
+    @classmethod
+    def update(cls, titles, links):
+        """Updates backlinks of the linked pages after pages with the titles
+        were saved, renamed or deleted.  Many links are updated by a task,
+        so that saving a page with hundreds of links doesn't wait for them."""
+        links = list(set(links))
+        if len(links) > cls.MAX_INLINE_UPDATES:
+            taskqueue.add(url=cls.UPDATE_URL, params={'title': titles, 'link': links})
+        else:
+            cls.sync(titles, links)
+
+    @classmethod
+    def sync(cls, titles, links):
+        """Makes backlinks of the linked pages match the current links of
+        pages with the titles: adds the titles of pages that link there and
+        removes the others (including pages that don't exist).  Doesn't
+        depend on the order of updates, so tasks can run late."""
+        pages = WikiContent.get_by_titles(titles)
+        linked = {}
+        for title in titles:
+            page = pages.get(title.replace('_', ' '))
+            linked[title] = page is not None and set(page.links) or set()
+        for link in set(links):
+            added = [title for title in titles if link in linked[title]]
+            removed = [title for title in titles if link not in linked[title]]
+            db.run_in_transaction(cls.__update, WikiContent.get_key_name(link), added, removed)
+
+    @classmethod
+    def add_many(cls, backlinks):
+        """Adds titles to backlinks of several pages, the argument maps linked
+        titles to lists of linking titles."""
+        for link, titles in backlinks.items():
+            db.run_in_transaction(cls.__update, WikiContent.get_key_name(link), titles, [])
+
+    @classmethod
+    def __update(cls, key_name, added, removed):
+        entry = cls.get_by_key_name(key_name)
+        if entry is None:
+            entry = cls(key_name=key_name)
+        titles = [title for title in entry.titles if title not in removed]
+        titles.extend([title for title in added if title not in titles])
+        if titles == entry.titles:
+            return
+        entry.titles = titles
+        entry.count = len(titles)
+        if titles:
+            entry.put()
+        elif entry.is_saved():
+            entry.delete()
+
+
+class SearchEntry(db.Model):
+    """Stores search terms of a page, under the page key name.  The datastore
+    index of the terms property is the inverted index: pages with a term are
+    found with a keys only query.  Terms of the title are indexed apart too,
+    so that the most relevant pages are always found.  Weights of the terms
+    are stored compressed, for ranking.  Entries are updated by
+    WikiContent.put(), the /w/migrate/search task creates them for older
+    pages."""
+    # Pages found by each query, before ranking: up to this many pages with
+    # the words in the title and as many with the words in the text.
+    MAX_CANDIDATES = 2000
+
+    title = db.StringProperty(indexed=False)
+    title_terms = db.StringListProperty()
+    terms = db.StringListProperty()
+    weights = db.BlobProperty()
+
+    @classmethod
+    def from_page(cls, page):
+        """Returns an entry for the page, to be saved by the caller.  Terms
+        are taken from the page text, without the header."""
+        weights = search.get_term_weights(page.title, page.get_parsed_page().get('text') or u'')
+        return cls(key_name=WikiContent.get_key_name(page.title),
+                   title=page.title,
+                   title_terms=sorted(set(search.tokenize(page.title.replace('_', ' ')))),
+                   terms=sorted(weights.keys()),
+                   weights=db.Blob(zlib.compress(simplejson.dumps(weights))))
+
+    @classmethod
+    def delete_for(cls, title):
+        db.delete(db.Key.from_path(cls.kind(), WikiContent.get_key_name(title)))
+
+    def get_score(self, terms, prefixes):
+        """Sums weights of the terms, and of the best term for each prefix.
+        Returns None if no term starts with one of the prefixes."""
+        weights = simplejson.loads(zlib.decompress(self.weights))
+        score = sum([weights.get(term, 0) for term in terms])
+        for prefix in prefixes:
+            matches = [weight for term, weight in weights.items() if term.startswith(prefix)]
+            if not matches:
+                return None
+            score += max(matches)
+        return score
+
+    @classmethod
+    def find_keys(cls, name, terms, prefix=None, limit=None):
+        """Returns keys of entries that have all the terms in the property,
+        or a term that starts with the prefix, fetched in batches until
+        there are no more (or limit keys were found)."""
+        query = cls.all(keys_only=True)
+        for term in terms:
+            query.filter(name + ' =', term)
+        if prefix is not None:
+            query.filter(name + ' >=', prefix).filter(name + ' <', prefix + u'\ufffd')
+        keys, cursor = fetch_page(query, limit=500)
+        while cursor and (limit is None or len(keys) < limit):
+            batch, cursor = fetch_page(query, cursor, 500)
+            keys.extend(batch)
+        return keys
+
+    @classmethod
+    def search(cls, query, is_readable, start=0, limit=20):
+        """Returns pages that match the query, most relevant first, and the
+        position of the next batch in the ranked list (or None).  Pages must
+        have all the terms and a term for each prefix (words that end with
+        *).  Pages for which is_readable(title) returns False are skipped,
+        they are loaded in batches so access checks don't load them one by
+        one."""
+        terms, prefixes = search.parse_query(query)
+        if not terms and not prefixes:
+            return [], None
+
+        ranked = cls.get_ranked_titles(terms, prefixes)
+        pages = []
+        position = start
+        while position < len(ranked) and len(pages) < limit:
+            batch = ranked[position:position + limit - len(pages)]
+            position += len(batch)
+            found = WikiContent.get_by_titles(batch)
+            for title in batch:
+                page = found.get(title)
+                if page is not None and is_readable(title):
+                    pages.append(page)
+        if position < len(ranked):
+            return pages, position
+        return pages, None
+
+    @classmethod
+    def get_ranked_titles(cls, terms, prefixes):
+        """Returns titles of pages that have all the terms and prefixes, most
+        relevant first.  The list is cached under the query and the search
+        generation, which is bumped when pages are saved or deleted, so later
+        batches of results only slice it."""
+        query = u' '.join(sorted(set(terms))) + u'|' + u' '.join(sorted(set(prefixes)))
+        key = 'Search:%u:%s' % (cache.get_generation('search'), hashlib.md5(query.encode('utf-8')).hexdigest())
+        ranked = cache.get_large(key)
+        if ranked is not None:
+            return ranked
+
+        # All terms are matched by the query, other prefixes than the first
+        # one are matched in memory, by get_score().
+        prefix = not terms and prefixes[0] or None
+        keys = cls.find_keys('title_terms', terms, prefix, cls.MAX_CANDIDATES)
+        keys.extend(cls.find_keys('terms', terms, prefix, cls.MAX_CANDIDATES))
+        keys = list(set(keys))
+
+        scores = []
+        for offset in range(0, len(keys), 500):
+            for entry in db.get(keys[offset:offset + 500]):
+                if entry is None:
+                    continue
+                score = entry.get_score(terms, prefixes)
+                if score is not None:
+                    scores.append((-score, entry.title.lower(), entry.title))
+        ranked = [title for score, sort_title, title in sorted(scores)]
+        cache.set_large(key, ranked)
+        return ranked
+
+
+class LinkGraphPart(db.Model):
+    """Titles and links of a batch of pages, saved by the link report task
+    as it walks the wiki, so that the last task can build the whole graph
+    without loading the pages.  The data is a compressed JSON list of
+    [title, links] pairs."""
+    data = db.BlobProperty()
+
+    @staticmethod
+    def get_key_name(number):
+        return 'part:%u' % number
+
+    @classmethod
+    def save(cls, number, pages):
+        data = [[page.title, page.links] for page in pages]
+        cls(key_name=cls.get_key_name(number), data=db.Blob(zlib.compress(simplejson.dumps(data)))).put()
+
+    @classmethod
+    def load(cls, count):
+        """Yields (title, links) pairs from the first count parts, loaded a
+        few at a time."""
+        for offset in range(0, count, 10):
+            keys = [cls.get_key_name(number) for number in range(offset, min(offset + 10, count))]
+            for part in cls.get_by_key_name(keys):
+                if part is not None:
+                    for title, links in simplejson.loads(zlib.decompress(part.data)):
+                        yield title, links
+
+    @classmethod
+    def delete_all(cls):
+        keys = cls.all(keys_only=True).fetch(500)
+        while keys:
+            db.delete(keys)
+            keys = cls.all(keys_only=True).fetch(500)
+
+
+class LinkReport(db.Model):
+    """A report on the link graph (e.g., orphan pages), stored as compressed
+    JSON under the report name.  Data that doesn't fit one entity is split
+    in chunks, stored under the name with the chunk number."""
+    NAMES = ('orphans', 'wanted', 'dead', 'important')
+    CHUNK_SIZE = 900 * 1000
+
+    data = db.BlobProperty()
+    chunks = db.IntegerProperty(default=1, indexed=False)
+    page_count = db.IntegerProperty(indexed=False)
+    updated = db.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def save(cls, name, value, page_count):
+        data = zlib.compress(simplejson.dumps(value))
+        chunks = [data[offset:offset + cls.CHUNK_SIZE] for offset in range(0, len(data), cls.CHUNK_SIZE)]
+        entities = [cls(key_name=name, data=db.Blob(chunks[0]), chunks=len(chunks), page_count=page_count)]
+        for number, chunk in enumerate(chunks[1:]):
+            entities.append(cls(key_name=u'%s:%u' % (name, number + 1), data=db.Blob(chunk)))
+        db.put(entities)
+
+    @classmethod
+    def load(cls, name):
+        """Returns the report and the entity that describes it (with the
+        number of pages and the time it was built), or (None, None)."""
+        report = cls.get_by_key_name(name)
+        if report is None:
+            return None, None
+        chunks = [report]
+        if report.chunks > 1:
+            chunks.extend(cls.get_by_key_name([u'%s:%u' % (name, number) for number in range(1, report.chunks)]))
+        if None in chunks:
+            return None, None
+        return simplejson.loads(zlib.decompress(''.join([chunk.data for chunk in chunks]))), report
+
+
+class SitemapShard(db.Model):
+    """Stores a part of the sitemap: the XML for readable pages with titles
+    from first_title up to the first_title of the next shard.  Shards are
+    built with up to SIZE pages each by a background task, after that
+    shards that contain edited pages are rebuilt one by one, so they can
+    grow until the next full build."""
+    SIZE = 1000
+
+    number = db.IntegerProperty(required=True)
+    first_title = db.StringProperty()
+    page_count = db.IntegerProperty(indexed=False)
+    xml = db.TextProperty()
+    updated = db.DateTimeProperty(auto_now=True)
+
+    @staticmethod
+    def get_key_name(number):
+        return 'shard:%u' % number
+
+    @classmethod
+    def get_by_number(cls, number):
+        return cls.get_by_key_name(cls.get_key_name(number))
+
+    @classmethod
+    def get_list(cls):
+        """Returns numbers and dates of all shards, without the XML."""
+        return db.Query(cls, projection=('number', 'updated')).order('number').fetch(1000)
+
+    @classmethod
+    def find_by_title(cls, title):
+        """Returns the shard that the page belongs to, or None if the sitemap
+        wasn't built yet."""
+        return cls.all().filter('first_title <=', title).order('-first_title').get()
+
+    def get_pages_query(self):
+        """Returns a query for pages in this shard."""
+        query = WikiContent.get_sitemap_query().filter('title >=', self.first_title)
+        next_shard = SitemapShard.all().filter('first_title >', self.first_title).order('first_title').get()
+        if next_shard is not None:
+            query.filter('title <', next_shard.first_title)
+        return query
+
+    @classmethod
+    def delete_from(cls, number):
+        """Deletes shards left from a bigger sitemap."""
+        db.delete(cls.all(keys_only=True).filter('number >=', number).fetch(1000))
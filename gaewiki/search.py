@@ -0,0 +1,62 @@
+# encoding=utf-8
+"""Text processing for the full text search, see model.SearchEntry."""
+
+import math
+import re
+
+
+WORD_PATTERN = re.compile(r'\w+', re.U)
+
+# Words that are too common to be worth indexing.
+STOP_WORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in',
+    'is', 'it', 'of', 'on', 'or', 'that', 'the', 'this', 'to', 'was',
+    'with', 'www', 'http', 'https', 'com',
+])
+
+# Terms from the title weigh as much as this many occurrences in the text.
+TITLE_BOOST = 10
+
+# The number of terms indexed per page, the most frequent ones are kept.
+MAX_TERMS = 1000
+
+# Longer words are cut, the datastore doesn't need them whole.
+MAX_TERM_LENGTH = 30
+
+
+def tokenize(text):
+    """Returns the list of terms in the text: lower case words, except for
+    numbers, single letters and stop words."""
+    terms = []
+    for word in WORD_PATTERN.findall(text.lower()):
+        if len(word) > 1 and not word.isdigit() and word not in STOP_WORDS:
+            terms.append(word[:MAX_TERM_LENGTH])
+    return terms
+
+
+def get_term_weights(title, text):
+    """Returns a dictionary of terms with their weights: the logarithm of the
+    number of occurrences, terms in the title are boosted."""
+    counts = {}
+    for term in tokenize(text):
+        counts[term] = counts.get(term, 0) + 1
+    for term in tokenize(title.replace('_', ' ')):
+        counts[term] = counts.get(term, 0) + TITLE_BOOST
+    if len(counts) > MAX_TERMS:
+        counts = dict(sorted(counts.items(), key=lambda item: item[1], reverse=True)[:MAX_TERMS])
+    return dict([(term, round(1 + math.log(count), 2)) for term, count in counts.items()])
+
+
+def parse_query(query):
+    """Returns the terms and the prefixes (words that end with *) that the
+    query consists of."""
+    terms = []
+    prefixes = []
+    for word in query.split():
+        if word.endswith('*'):
+            words = tokenize(word[:-1])
+            terms.extend(words[:-1])
+            prefixes.extend(words[-1:])
+        else:
+            terms.extend(tokenize(word))
+    return terms, prefixes
@@ -1,5 +1,6 @@
 # encoding=utf-8
 
+import cache
 import model
 import util
 
@@ -27,7 +28,10 @@ Edit me."""
 
 def get_host_page():
     """Returns the page that hosts the settings."""
-    page = model.WikiContent.gql('WHERE title = :1', SETTINGS_PAGE_NAME).get()
+    page = model.WikiContent.get_by_key_name(model.WikiContent.get_key_name(SETTINGS_PAGE_NAME))
+    if page is None:
+        # Can't use get_by_title() here, it needs the settings.
+        page = model.WikiContent.gql('WHERE title = :1', SETTINGS_PAGE_NAME).get()
     if page is None:
         page = model.WikiContent(title=SETTINGS_PAGE_NAME, body=DEFAULT_SETTINGS)
         page.put()
@@ -35,10 +39,15 @@ def get_host_page():
 
 
 def get_all():
-    settings = memcache.get('gaewiki:settings')
-    if settings is None:
-        settings = util.parse_page(get_host_page().body)
-        memcache.set('gaewiki:settings', settings)
+    """Returns the settings dictionary, loads it from memcache once per
+    request."""
+    settings = cache.request_get('settings')
+    if settings is cache.MISSING:
+        settings = memcache.get('gaewiki:settings')
+        if settings is None:
+            settings = util.parse_page(get_host_page().body)
+            memcache.set('gaewiki:settings', settings)
+        cache.request_set('settings', settings)
     return settings
 
 
@@ -47,9 +56,15 @@ def get(key, default_value=None):
 
 
 def check_and_flush(page):
-    """Empties settings cache if the host page is updated."""
+    """Empties settings cache if the host page is updated.  Drops the rendered
+    sidebar and footer if their pages or the settings are updated."""
     if page.title == SETTINGS_PAGE_NAME:
         memcache.delete('gaewiki:settings')
+        cache.request_delete('settings')
+        cache.bump_generations(['links', 'settings'])
+        cache.flush_fragments()
+    elif page.title in (get('sidebar', 'gaewiki:sidebar'), get('footer', 'gaewiki:footer')):
+        cache.flush_fragments()
 
 
 def change(upd):
@@ -1,12 +1,21 @@
 # encoding=utf-8
 
+import datetime
+import time
 import unittest
+import urllib
 
+from google.appengine.api import memcache
 from google.appengine.api import users
+from google.appengine.ext import db
 from google.appengine.ext import testbed
 
 import access
+import cache
+import diff
+import graph
 import model
+import search
 import settings
 import util
 
@@ -16,6 +25,13 @@ try:
 except:
     TEST_VIEWS = False
 
+try:
+    import handlers
+    from google.appengine.ext import webapp
+    TEST_HANDLERS = True
+except ImportError:
+    TEST_HANDLERS = False
+
 
 class TestCase(unittest.TestCase):
     """Base class for all tests, initializes the datastore testbed (in-memory
@@ -25,11 +41,28 @@ class TestCase(unittest.TestCase):
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub()
         self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub()
         settings.settings = None
+        cache.clear_request_cache()
+        cache.render_cache.clear()
+        access.cached_policy = None
 
     def tearDown(self):
         self.testbed.deactivate()
 
+    def post_task(self, handler_class, params, from_queue=True):
+        """Runs a task handler with the parameters, as the task queue would
+        (or as an outside request), returns the response."""
+        headers = {}
+        if from_queue:
+            headers['X-AppEngine-QueueName'] = 'default'
+        request = webapp.Request.blank(handler_class.url, POST=urllib.urlencode(params, True), headers=headers)
+        response = webapp.Response()
+        handler = handler_class()
+        handler.initialize(request, response)
+        handler.post()
+        return response
+
     def test_page_packing(self):
         """Tests whether page haders can be built correctly."""
         header = util.pack_page_header({
@@ -82,6 +115,16 @@ class TestCase(unittest.TestCase):
         for got, wanted in checks:
             self.assertEquals(util.wikify(got), wanted)
 
+    def test_wikify_existing_links(self):
+        model.WikiContent(title='foo bar', body='# foo bar').put()
+        self.assertEquals(util.wikify('[[foo_bar]], [[baz]]'), '<a class="int" href="/foo_bar" title="foo_bar">foo_bar</a>, <a class="int missing" href="/w/edit?page=baz" title="baz (create)">baz</a>')
+
+    def test_get_pages_by_titles(self):
+        model.WikiContent(title='foo', body='# foo').put()
+        model.WikiContent(title='bar', body='# bar').put()
+        titles = ['page %u' % idx for idx in range(50)] + ['foo', 'bar']
+        self.assertEquals(sorted(model.WikiContent.get_by_titles(titles).keys()), ['bar', 'foo'])
+
     def test_page_creation(self):
         self.assertEquals(len(model.WikiContent.get_all()), 0)
         model.WikiContent(title='foo').put()
@@ -202,6 +245,188 @@ class TestCase(unittest.TestCase):
 
         settings.change({"open-reading": "no", "open-writing": "no"})
         self.assertTrue(isinstance(model.WikiContent.get_changes(), list))
+        self.assertTrue(isinstance(model.WikiContent.get_changes(slim=True), list))
+
+    def test_cursor_pagination(self):
+        for idx in range(5):
+            model.WikiContent(title='page%u' % idx, body='labels: foo\n---\n# page').put()
+        pages, cursor = model.WikiContent.get_label_page('foo', limit=3)
+        self.assertEquals([p.title for p in pages], ['page0', 'page1', 'page2'])
+        pages, cursor = model.WikiContent.get_label_page('foo', cursor, limit=3)
+        self.assertEquals([p.title for p in pages], ['page3', 'page4'])
+        self.assertEquals(cursor, None)
+
+        pages, cursor = model.WikiContent.get_index('bad cursor', limit=10)
+        self.assertEquals(len([p for p in pages if p.title.startswith('page')]), 5)
+
+    def test_sitemap_shards(self):
+        settings.change({'open-reading': 'yes'})
+        for title in ('a', 'b', 'c', 'd'):
+            model.WikiContent(title=title, body='# ' + title).put()
+        self.assertEquals(model.SitemapShard.find_by_title('a'), None)
+
+        model.SitemapShard(key_name=model.SitemapShard.get_key_name(0), number=0, first_title=u'').put()
+        model.SitemapShard(key_name=model.SitemapShard.get_key_name(1), number=1, first_title=u'c').put()
+        self.assertEquals(model.SitemapShard.find_by_title('b').number, 0)
+        self.assertEquals(model.SitemapShard.find_by_title('d').number, 1)
+        self.assertEquals([p.title for p in model.SitemapShard.get_by_number(0).get_pages_query()], ['a', 'b'])
+        self.assertEquals([s.number for s in model.SitemapShard.get_list()], [0, 1])
+
+        model.SitemapShard.delete_from(1)
+        self.assertEquals(model.SitemapShard.get_by_number(1), None)
+
+    def test_sitemap_build(self):
+        if not TEST_HANDLERS:
+            return
+        settings.change({'open-reading': 'yes', 'base-url': 'http://wiki.example.com/'})
+        for title in ('a', 'b'):
+            model.WikiContent(title=title, body='# ' + title).put()
+        stale = model.SitemapShard(key_name=model.SitemapShard.get_key_name(1), number=1, first_title=u'c')
+        stale.put()
+
+        self.post_task(handlers.SitemapBuildHandler, {'batch': 0})
+        self.assertTrue('http://wiki.example.com/a' in model.SitemapShard.get_by_number(0).xml)
+        self.assertEquals(model.SitemapShard.get_by_number(1), None)
+
+        # The last batch is empty, the stale shard has its number.
+        stale.put()
+        query = model.WikiContent.get_sitemap_query()
+        query.fetch(1000)
+        self.post_task(handlers.SitemapBuildHandler, {'batch': 1, 'cursor': query.cursor()})
+        self.assertEquals(model.SitemapShard.get_by_number(1), None)
+        self.assertNotEquals(model.SitemapShard.get_by_number(0), None)
+
+        shard = model.SitemapShard.get_by_number(0)
+        shard.xml = u''
+        shard.put()
+        self.post_task(handlers.SitemapUpdateHandler, {'page': 'a'}, from_queue=False)
+        self.assertEquals(model.SitemapShard.get_by_number(0).xml, u'')
+        self.post_task(handlers.SitemapUpdateHandler, {'page': 'a'})
+        self.assertTrue('http://wiki.example.com/b' in model.SitemapShard.get_by_number(0).xml)
+
+    def test_backlink_index(self):
+        model.WikiContent(title=u'one', body=u'[[hub]], [[two]]').put()
+        model.WikiContent(title=u'two', body=u'[[hub]]').put()
+        self.assertEquals(model.BackLinks.get_titles(u'hub'), [u'one', u'two'])
+        self.assertEquals(model.BackLinks.get_most_linked(1), [(u'hub', 2)])
+
+        page = model.WikiContent.get_by_title(u'one')
+        page.body = u'name: three\n---\n[[two]]'
+        page.put()
+        self.assertEquals(model.BackLinks.get_titles(u'hub'), [u'two'])
+        self.assertEquals(model.BackLinks.get_titles(u'two'), [u'three'])
+
+        model.WikiContent.get_by_title(u'two').delete()
+        self.assertEquals(model.BackLinks.get_titles(u'hub'), [])
+        self.assertEquals(model.BackLinks.get_by_key_name(u'page:hub'), None)
+
+        settings.change({'backlink-index': 'yes'})
+        self.assertEquals(model.WikiContent.find_backlink_titles(u'two'), [u'three'])
+
+    def test_backlink_tasks(self):
+        if not TEST_HANDLERS:
+            return
+        links = [u'target %u' % idx for idx in range(model.BackLinks.MAX_INLINE_UPDATES + 1)]
+        page = model.WikiContent(title=u'hub', body=u', '.join([u'[[%s]]' % link for link in links]))
+        page.put()
+        self.assertEquals(model.BackLinks.get_titles(links[0]), [])
+
+        params = {'title': u'hub', 'link': links}
+        self.post_task(handlers.BackLinkUpdateHandler, params, from_queue=False)
+        self.assertEquals(model.BackLinks.get_titles(links[0]), [])
+        self.post_task(handlers.BackLinkUpdateHandler, params)
+        self.assertEquals(model.BackLinks.get_titles(links[0]), [u'hub'])
+
+        # Tasks that run late see the current links.
+        page.body = u'[[target 1]]'
+        page.put()
+        self.post_task(handlers.BackLinkUpdateHandler, params)
+        self.assertEquals(model.BackLinks.get_titles(links[0]), [])
+        self.assertEquals(model.BackLinks.get_titles(links[1]), [u'hub'])
+
+        self.post_task(handlers.BackLinkIndexHandler, {}, from_queue=False)
+        self.assertEquals(settings.get('backlink-index'), None)
+
+    def test_link_graph(self):
+        links = graph.LinkGraph(util.SPECIAL_LINK_PREFIXES + ('wp', ))
+        links.add_page(u'Home', [u'About', u'Missing', u'Home', u'List:news', u'ListChildren:', u'Image:123', u'wp:Foo'])
+        links.add_page(u'About', [u'Home', u'Missing', u'Other_missing'])
+        links.add_page(u'Lost', [u'Home'])
+        self.assertEquals(links.get_orphans(), [u'Lost'])
+        self.assertEquals(links.get_wanted(), [(u'Missing', 2), (u'Other missing', 1)])
+        self.assertEquals(links.get_dead_links(), [(u'About', [u'Missing', u'Other missing']), (u'Home', [u'Missing'])])
+        important = links.get_important()
+        self.assertEquals([title for title, rank in important], [u'Home', u'About', u'Lost'])
+        self.assertAlmostEquals(sum([rank for title, rank in important]), 3, 2)
+
+        model.LinkReport.CHUNK_SIZE = 100
+        try:
+            model.LinkReport.save('orphans', [u'page %u' % idx for idx in range(1000)], 1000)
+        finally:
+            model.LinkReport.CHUNK_SIZE = 900 * 1000
+        report, info = model.LinkReport.load('orphans')
+        self.assertTrue(info.chunks > 1)
+        self.assertEquals(report[999], u'page 999')
+        self.assertEquals(model.LinkReport.load('wanted'), (None, None))
+
+    def test_search(self):
+        self.assertEquals(search.tokenize(u'The Quick, quick fox 42 a'), [u'quick', u'quick', u'fox'])
+        self.assertEquals(search.parse_query(u'quick fo*'), ([u'quick'], [u'fo']))
+
+        model.WikiContent(title=u'Foxes', body=u'Some animals.').put()
+        model.WikiContent(title=u'Animals', body=u'Foxes and dogs are animals.').put()
+        model.WikiContent(title=u'Secret', body=u'Foxes everywhere.').put()
+
+        def readable(title):
+            return title != u'Secret'
+
+        pages, cursor = model.SearchEntry.search(u'foxes', readable)
+        self.assertEquals([page.title for page in pages], [u'Foxes', u'Animals'])
+        self.assertEquals(cursor, None)
+
+        pages, cursor = model.SearchEntry.search(u'animals fox*', readable, limit=1)
+        self.assertEquals([page.title for page in pages], [u'Animals'])
+        self.assertEquals(cursor, 1)
+        # The next batch slices the cached ranking.
+        model.SearchEntry.delete_for(u'Foxes')
+        pages, cursor = model.SearchEntry.search(u'animals fox*', readable, cursor, limit=1)
+        self.assertEquals([page.title for page in pages], [u'Foxes'])
+
+        pages, cursor = model.SearchEntry.search(u'fo* do*', readable)
+        self.assertEquals([page.title for page in pages], [u'Animals'])
+        self.assertEquals(model.SearchEntry.search(u'zzz*', readable), ([], None))
+
+        model.WikiContent.get_by_title(u'Foxes').delete()
+        pages, cursor = model.SearchEntry.search(u'foxes', readable)
+        self.assertEquals([page.title for page in pages], [u'Animals'])
+
+    def test_change_log(self):
+        settings.change({'open-reading': 'yes'})
+        page = model.WikiContent(title='foo')
+        page.update(body='summary: first\n---\n# foo', author=None, delete=False)
+        changes = model.WikiChange.get_recent()
+        self.assertEquals([c.title for c in changes], ['foo'])
+        self.assertEquals(changes[0].summary, 'first')
+
+        since = changes[0].created
+        page.update(body='# foo', author=None, delete=True)
+        changes = model.WikiChange.get_recent(since)
+        self.assertEquals(len(changes), 1)
+        self.assertEquals(changes[0].deleted, True)
+
+        secret = model.WikiContent(title='secret')
+        secret.update(body='private: yes\nsummary: hidden\n---\n# secret', author=None, delete=False)
+        self.assertEquals(model.WikiChange.get_recent(limit=1)[0].summary, None)
+
+    def test_slim_listings(self):
+        model.WikiContent(title='foo', body='# foo').put()
+        model.WikiContent(title='gaewiki:bar', body='# bar').put()
+        pages, cursor = model.WikiContent.get_index()
+        self.assertEquals([p.title for p in pages], ['foo', 'gaewiki:bar'])
+        self.assertEquals(pages[0].body, None)
+
+        settings.change({'open-reading': 'yes'})
+        self.assertEquals([p.title for p in model.WikiContent.get_publicly_readable()], ['foo', 'gaewiki:bar', 'gaewiki:settings'])
 
     def test_edit_page_with_local_editors(self):
         pass
@@ -245,6 +470,43 @@ class TestCase(unittest.TestCase):
         page.put()
         self.assertEquals(access.can_read_page('foo', user, False), True)
 
+    def test_persisted_acl(self):
+        page = model.WikiContent(title='foo', body='private: yes\nreaders: alice@example.com, bob@example.com\n---\n# foo')
+        page.put()
+        self.assertEquals(page.private, True)
+        self.assertEquals(page.public, False)
+        self.assertEquals(page.readers, ['alice@example.com', 'bob@example.com'])
+        self.assertEquals(page.editors, [])
+
+        # Pages saved before the properties existed.
+        page.private = None
+        page.body = 'public: yes\n---\n# foo'
+        settings.change({'open-reading': 'no', 'readers': None, 'editors': None})
+        self.assertEquals(access.can_read_page('foo', None, False), True)
+
+    def test_page_metadata(self):
+        page = model.WikiContent(title='foo', body='display_title: Foo Bar\nlocked: yes\nfile: http://example.com/foo.mp3\n---\n# foo')
+        page.put()
+        page = model.WikiContent.get_by_key_name(page.key().name())
+        self.assertEquals(page.display_title, 'Foo Bar')
+        self.assertEquals(page.locked, True)
+        self.assertEquals(page.get_file(), 'http://example.com/foo.mp3')
+
+        # Replaced bodies (previews, old revisions) are parsed again.
+        page.body = '# foo'
+        self.assertEquals(page.get_display_title(), 'foo')
+        self.assertEquals(page.is_locked(), False)
+
+    def test_access_policy(self):
+        settings.change({'page-blacklist': '^foo', 'editors': 'alice@example.com'})
+        policy = access.get_policy()
+        self.assertTrue(access.get_policy() is policy)
+        self.assertTrue(policy.is_blacklisted('foobar'))
+        self.assertEquals(policy.editors, set(['alice@example.com']))
+
+        settings.change({'page-blacklist': '^bar'})
+        self.assertFalse(access.get_policy().is_blacklisted('foobar'))
+
     def test_access_to_special_pages(self):
         user = users.User('alice@example.com')
 
@@ -293,6 +555,290 @@ class TestCase(unittest.TestCase):
         p2 = model.WikiContent.get_by_title('Hello_World')
         self.assertEquals(p1.key(), p2.key())
 
+    def test_title_keys(self):
+        page = model.WikiContent(title='foo_bar', body='# foo')
+        page.put()
+        self.assertEquals(page.key().name(), u'page:foo bar')
+
+        page.body = 'name: baz\n---\n# baz'
+        page.put()
+        self.assertEquals(page.key().name(), u'page:baz')
+        self.assertEquals(model.WikiContent.get_by_title('foo bar', create_if_none=False), None)
+        self.assertEquals(model.WikiContent.get_by_title('baz').key(), page.key())
+        self.assertEquals(len(model.WikiContent.get_all()), 1)
+
+    def test_wait_for_value(self):
+        memcache.set('ready', u'value')
+        self.assertEquals(cache.wait_for_value('ready', timeout=0.2), u'value')
+        self.assertEquals(cache.wait_for_value('missing', timeout=0.2), None)
+
+        cache.mark_failed('broken')
+        started = time.time()
+        self.assertEquals(cache.wait_for_value('broken'), None)
+        self.assertTrue(time.time() - started < 1)
+
+    def test_cache_lease(self):
+        if not TEST_HANDLERS:
+            return
+
+        class Handler(handlers.RequestHandler):
+            renders = []
+            fail = False
+
+            def get_memcache_key(self):
+                return 'Test:'
+
+            def get_content(self):
+                self.renders.append(1)
+                if self.fail:
+                    raise handlers.NotFound('No such page.')
+                return u'version %u' % len(self.renders)
+
+        settings.change({'cache-stale-while-revalidate': 'yes'})
+        handler = Handler()
+        self.assertEquals(handler.get_memcache(), u'version 1')
+        self.assertEquals(handler.get_memcache(), u'version 1')
+
+        # Another request renders the new version, this one gets the old one.
+        cache.bump_generation('global')
+        key = handler.get_versioned_memcache_key()
+        self.assertTrue(cache.acquire_lease(key))
+        self.assertEquals(handler.get_memcache(), u'version 1')
+        self.assertEquals(len(Handler.renders), 1)
+        handler.initialize(webapp.Request.blank('/'), webapp.Response())
+        handler.reply_cached('text/html')
+        self.assertFalse('ETag' in handler.response.headers)
+        cache.release_lease(key)
+
+        # The lease holder fails, requests that wait for it give up early.
+        handler.fail = True
+        self.assertRaises(handlers.NotFound, handler.get_memcache)
+        self.assertEquals(memcache.get(key), cache.FAILED)
+        settings.change({'cache-stale-while-revalidate': 'no'})
+        self.assertTrue(cache.acquire_lease(key))
+        started = time.time()
+        self.assertRaises(handlers.NotFound, handler.get_memcache)
+        self.assertTrue(time.time() - started < 1)
+
+    def test_cache_purge(self):
+        if not TEST_HANDLERS:
+            return
+        model.WikiContent(title=u'parent', body=u'[[ListChildren:]]').put()
+        model.WikiContent(title=u'dated', body=u'[[List:news;sort=date,desc]]').put()
+        model.WikiContent(title=u'plain', body=u'[[List:news]]').put()
+        model.WikiContent(title=u'other', body=u'[[List:newsletter]]').put()
+        params = {
+            'page': u'parent/child',
+            'label': [u'news', u'gaewiki:parent:parent'],
+            'links': 'yes',
+        }
+
+        bumped = []
+        bump_generations = cache.bump_generations
+        cache.bump_generations = bumped.extend
+        try:
+            self.post_task(handlers.CachePurgeHandler, params, from_queue=False)
+            self.assertEquals(bumped, [])
+            self.post_task(handlers.CachePurgeHandler, params)
+        finally:
+            cache.bump_generations = bump_generations
+        self.assertEquals(sorted(bumped), sorted([u'index', u'label:news', u'label:gaewiki:parent:parent',
+                                                  u'page:parent/child', u'page:parent', u'page:dated', u'page:plain']))
+
+    def test_edit_purge(self):
+        if not TEST_HANDLERS:
+            return
+        settings.change({'open-editing': 'yes'})
+        model.WikiContent(title=u'foo', body=u'# foo').put()
+        generation = cache.get_generation(u'page:foo')
+        viewer = handlers.PageHandler()
+        viewer.initialize(webapp.Request.blank('/foo'), webapp.Response())
+        viewer.title, viewer.raw, viewer.revision = u'foo', False, ''
+        etag = viewer.get_etag()
+
+        request = webapp.Request.blank('/w/edit', POST=urllib.urlencode({'name': 'foo', 'body': '# bar'}))
+        handler = handlers.EditHandler()
+        handler.initialize(request, webapp.Response())
+        handler.post()
+        self.assertTrue(handler.response.headers['Location'].endswith('/foo'))
+        self.assertTrue(cache.get_generation(u'page:foo') > generation)
+        self.assertNotEquals(viewer.get_etag(), etag)
+
+    def test_changes_since(self):
+        if not TEST_HANDLERS:
+            return
+        handler = handlers.ChangesHandler()
+        handler.initialize(webapp.Request.blank('/w/changes?since=0'), webapp.Response())
+        self.assertEquals(handler.get_since(), datetime.datetime(1970, 1, 1))
+        for since in ('foo', '1e400'):
+            handler.initialize(webapp.Request.blank('/w/changes?since=' + since), webapp.Response())
+            self.assertRaises(handlers.BadRequest, handler.get_since)
+
+    def test_title_key_migration(self):
+        if not TEST_HANDLERS:
+            return
+        legacy = model.WikiContent(title='foo', key_name='legacy', body='# foo')
+        db.Model.put(legacy)
+
+        self.post_task(handlers.TitleKeyMigrationHandler, {}, from_queue=False)
+        self.assertEquals(model.WikiContent.get_by_key_name('legacy').title, 'foo')
+        self.assertEquals(settings.get('title-keys'), None)
+
+        duplicate = model.WikiContent(title='bar', key_name='duplicate', body='# bar')
+        db.Model.put(duplicate)
+        model.WikiContent(title='bar', body='# bar').put()
+        self.post_task(handlers.TitleKeyMigrationHandler, {})
+        self.assertEquals(model.WikiContent.get_by_key_name('legacy'), None)
+        self.assertEquals(settings.get('title-keys'), None)
+
+        db.delete(duplicate)
+        self.post_task(handlers.TitleKeyMigrationHandler, {})
+        self.assertEquals(settings.get('title-keys'), 'yes')
+
+    def test_legacy_page_lookup(self):
+        legacy = model.WikiContent(title='foo', key_name='legacy', body='# foo')
+        db.Model.put(legacy)  # bypass the rekeying
+        self.assertEquals(model.WikiContent.get_by_title('foo').key(), legacy.key())
+        self.assertEquals(model.WikiContent.get_by_titles(['foo'])['foo'].key(), legacy.key())
+
+        legacy.put()
+        self.assertEquals(legacy.key().name(), u'page:foo')
+        self.assertEquals(len(model.WikiContent.get_all()), 1)
+
+    def test_underscore_titles(self):
+        page = model.WikiContent(title='foo', body='name: foo_bar\n---\n# foo')
+        page.put()
+        self.assertEquals(page.title, 'foo_bar')
+        cache.clear_request_cache()
+        self.assertEquals(model.WikiContent.get_by_titles(['foo_bar']).keys(), ['foo bar'])
+        self.assertEquals(model.WikiContent.get_by_title('foo bar', create_if_none=False).key(), page.key())
+
+    def test_request_cache(self):
+        page = model.WikiContent(title='foo', body='# foo')
+        page.put()
+        self.assertTrue(model.WikiContent.get_by_title('foo') is page)
+        self.assertEquals(model.WikiContent.get_by_title('bar', create_if_none=False), None)
+
+        hits = cache.get_request_stats()['hits']
+        model.WikiContent.get_by_titles(['foo', 'bar'])
+        self.assertEquals(cache.get_request_stats()['hits'], hits + 2)
+
+        page.delete()
+        self.assertEquals(model.WikiContent.get_by_title('foo', create_if_none=False), None)
+
+    def test_fragment_flushing(self):
+        page = model.WikiContent(title='foo', body='# foo')
+        page.put()
+        cache.set_fragment('sidebar', 'html')
+        page.body = '# foo\n\nchanged'
+        page.put()
+        self.assertEquals(cache.get_fragment('sidebar'), 'html')
+
+        page.body = 'labels: bar\n---\n# foo'
+        page.put()
+        self.assertEquals(cache.get_fragment('sidebar'), None)
+        cache.set_fragment('sidebar', 'html')
+        page.body = 'labels: bar\n---\n# foo\n\nchanged'
+        page.put()
+        self.assertEquals(cache.get_fragment('sidebar'), 'html')
+        page.body = 'labels: bar\ndisplay_title: Foo\n---\n# foo'
+        page.put()
+        self.assertEquals(cache.get_fragment('sidebar'), None)
+
+        model.WikiContent(title='gaewiki:sidebar', body='[[foo]]').put()
+        self.assertEquals(cache.get_fragment('sidebar'), None)
+
+    def test_render_cache(self):
+        text = util.wikify_filter('[[foo]]')
+        self.assertTrue('missing' in text)
+        self.assertEquals(util.wikify_filter('[[foo]]'), text)
+
+        model.WikiContent(title='foo', body='# foo').put()
+        self.assertFalse('missing' in util.wikify_filter('[[foo]]'))
+
+    def test_generations(self):
+        values = cache.get_generations(['global', u'page:foo'])
+        self.assertEquals(cache.get_generations(['global', u'page:foo']), values)
+
+        cache.bump_generations([u'page:foo'])
+        self.assertEquals(cache.get_generation('global'), values['global'])
+        self.assertEquals(cache.get_generation(u'page:foo'), values[u'page:foo'] + 1)
+
+    def test_large_values(self):
+        value = {'content': 'x' * (cache.CHUNK_SIZE * 2 + 10)}
+        self.assertTrue(cache.set_large('foo', value))
+        self.assertEquals(cache.get_large('foo'), value)
+
+        # A missing chunk makes the value missing.
+        prefix = memcache.get('foo')[1]
+        memcache.delete(prefix + '1')
+        self.assertEquals(cache.get_large('foo'), None)
+
+        cache.set_large('bar', 'small')
+        self.assertEquals(memcache.get('bar'), 'small')
+
+    def test_delta(self):
+        old = u'one\ntwo\nthree\n'
+        new = u'one\n2\nthree\nfour'
+        self.assertEquals(diff.apply_delta(old, diff.make_delta(old, new)), new)
+
+    def test_diff(self):
+        a = 'abcabba'
+        b = 'cbabac'
+        equal = sum([i2 - i1 for tag, i1, i2, j1, j2 in diff.get_opcodes(a, b) if tag == 'equal'])
+        self.assertEquals(equal, 4)
+
+        html = u''.join(diff.render_html(u'one\ntwo <b>\nthree', u'one\ntwo <i>\nthree'))
+        self.assertTrue(u'<del>b</del>' in html)
+        self.assertTrue(u'&lt;<ins>i</ins>&gt;' in html)
+
+    def test_compressed_revisions(self):
+        text = u''.join([u'line %u\n' % idx for idx in range(100)])
+        page = model.WikiContent(title='foo')
+        page.update(body=text, author=None, delete=False)
+        page.update(body=text + u'more', author=None, delete=False)
+        page.update(body=text + u'even more', author=None, delete=False)
+        revisions = model.WikiRevision.all().order('created').fetch(10)
+        self.assertEquals(len(revisions), 2)
+        self.assertTrue(revisions[0].is_keyframe())
+        self.assertFalse(revisions[1].is_keyframe())
+        self.assertEquals(revisions[1].get_body(), text + u'more')
+        self.assertEquals(revisions[1].size_change, 4)
+        self.assertEquals(revisions[1].delta, None)
+
+        # Revisions saved before compression.
+        legacy = model.WikiRevision(title='bar', revision_body=text)
+        legacy.put()
+        model.WikiRevision(title='bar', revision_body=text + u'more').put()
+        self.assertEquals(model.WikiRevision.compact('bar'), 2)
+        revisions = model.WikiRevision.all().filter('title =', 'bar').order('created').fetch(10)
+        self.assertEquals(revisions[0].revision_body, None)
+        self.assertEquals(revisions[1].base.key(), legacy.key())
+        self.assertEquals(revisions[1].get_body(), text + u'more')
+
+    def test_history_authors(self):
+        page = model.WikiContent(title='foo')
+        for idx in range(3):
+            page.update(body=u'version %u' % idx, author=users.User('alice@example.com'), delete=False)
+        revisions, cursor = page.get_history_page()
+        # Authors are already loaded, the entities are no longer needed.
+        db.delete(model.WikiUser.all(keys_only=True).fetch(10))
+        self.assertEquals([revision.author.get_nickname() for revision in revisions], [u'alice', u'alice'])
+
+    def test_gzip(self):
+        data = cache.gzip_compress(u'привет, мир')
+        self.assertTrue(data.startswith('\x1f\x8b'))
+        self.assertEquals(cache.gzip_decompress(data), u'привет, мир')
+
+    def test_lru_cache(self):
+        lru = cache.LRUCache(6)
+        lru.set('a', 'aaa')
+        lru.set('b', 'bbb')
+        lru.get('a')
+        lru.set('c', 'ccc')
+        self.assertEquals(lru.get('b'), None)
+        self.assertEquals(lru.get('a'), 'aaa')
+
     def test_page_redirect(self):
         """Makes sure that redirects are supported when displaying pages."""
         if not TEST_VIEWS:
@@ -1,11 +1,14 @@
 # encoding=utf-8
 
 import cgi
+import hashlib
 import logging
 import os
 import re
+import threading
 import urllib
 
+import cache
 import markdown
 import model
 import settings
@@ -14,6 +17,10 @@ import images
 
 cleanup_re_1 = re.compile('<h\d>.*', re.MULTILINE | re.DOTALL)
 
+# Idle Markdown converters, by extension list, see get_markdown().
+markdown_pool = {}
+markdown_pool_lock = threading.Lock()
+
 
 def parse_page(page_content):
     return model.WikiContent.parse_body(page_content)
@@ -32,6 +39,23 @@ def pageurl_rel(title):
 
 
 def wikify_filter(text, display_title=None, page_name=None):
+    """Renders page source to HTML.  Results are cached by a hash of the
+    arguments and the markdown settings, the links generation is a part of
+    the key so that the link classes and page lists stay current."""
+    key = get_render_key(text, display_title, page_name)
+    html = cache.get_rendered(key)
+    if html is None:
+        html = render_page_text(text, display_title, page_name)
+        cache.set_rendered(key, html)
+    return html
+
+
+def get_render_key(text, display_title=None, page_name=None):
+    source = repr((unicode(text), display_title, page_name, settings.get('markdown-extensions', [])))
+    return '%s:%s' % (cache.get_generation('links'), hashlib.md5(source).hexdigest())
+
+
+def render_page_text(text, display_title=None, page_name=None):
     props = parse_page(text)
     text = parse_markdown(props['text'])
 
@@ -50,21 +74,65 @@ def wikify_filter(text, display_title=None, page_name=None):
 
 
 def parse_markdown(text):
-    return markdown.markdown(text, settings.get('markdown-extensions', [])).strip()
+    extensions = tuple(settings.get('markdown-extensions', []))
+    md = get_markdown(extensions)
+    html = md.convert(text).strip()
+    release_markdown(extensions, md)
+    return html
+
+
+def get_markdown(extensions):
+    """Returns an idle Markdown converter for the extension list.  Building a
+    converter (loading the extensions, setting up all processors) costs more
+    than most conversions, so converters are reused, see release_markdown()."""
+    markdown_pool_lock.acquire()
+    try:
+        idle = markdown_pool.get(extensions)
+        if idle:
+            return idle.pop()
+    finally:
+        markdown_pool_lock.release()
+    return markdown.Markdown(extensions=markdown.load_extensions(extensions))
+
+
+def release_markdown(extensions, md):
+    """Resets the converter and puts it back to the pool."""
+    md.reset()
+    markdown_pool_lock.acquire()
+    try:
+        markdown_pool.setdefault(extensions, []).append(md)
+    finally:
+        markdown_pool_lock.release()
 
 
 WIKI_WORD_PATTERN = re.compile("\[\[(.+?)\]\]")
 
+# Link prefixes that are rendered by wikify_one() without looking pages up.
+SPECIAL_LINK_PREFIXES = ('List', 'ListChildren', 'gaewiki', 'Image')
+
 
 def wikify(text, title=None):
-    text, count = WIKI_WORD_PATTERN.subn(lambda x: wikify_one(x, title), text)
+    existing = get_existing_links(text)
+    text, count = WIKI_WORD_PATTERN.subn(lambda x: wikify_one(x, title, existing), text)
     text = re.sub(r'\.  ', '.&nbsp; ', text)
     text = re.sub(u' +(—|--) +', u'&nbsp;— ', text)
     return text
 
 
-def wikify_one(pat, real_page_title):
-    """Wikifies one link."""
+def get_existing_links(text):
+    """Returns titles of existing pages that the text links to, resolved with
+    a single batched lookup so that wikify_one() doesn't need to query the
+    datastore for every link."""
+    titles = [link for link in extract_links(text) if link.split(':', 1)[0] not in SPECIAL_LINK_PREFIXES]
+    if not titles:
+        return set()
+    return set(model.WikiContent.get_by_titles(titles).keys())
+
+
+def wikify_one(pat, real_page_title, existing=None):
+    """Wikifies one link.  The existing argument is an optional set of titles
+    known to exist (see get_existing_links), pages not in it are considered
+    missing."""
     page_name = page_title = pat.group(1)
     if "|" in page_name:
         page_name, page_title = page_name.split("|", 1)
@@ -87,14 +155,18 @@ def wikify_one(pat, real_page_title):
             if iwlink:
                 return '<a class="iw iw-%s" href="%s" target="_blank">%s</a>' % (parts[0], iwlink.replace('%s', urllib.quote(parts[1].encode('utf-8'))), page_title)
 
-    page = model.WikiContent.get_by_title(page_name)
+    if existing is not None:
+        is_missing = page_name.replace('_', ' ') not in existing
+    else:
+        page = model.WikiContent.get_by_title(page_name)
+        is_missing = page is None or not page.is_saved()
 
     page_class = "int"
     page_link = pageurl(page_name)
     page_hint = page_name
     page_text = page_title
 
-    if page is None or not page.is_saved():
+    if is_missing:
         page_class += " missing"
         page_hint += " (create)"
         page_link = "/w/edit?page=" + pageurl_rel(page_name)
@@ -137,11 +209,10 @@ def render_image(args, title):
 def list_pages_by_label(label):
     """Returns a formatted list of pages with the specified label."""
     keys = label.split(';')
-    pages = model.WikiContent.get_by_label(keys[0])
+    by_date = 'sort=date,desc' in keys
+    pages, cursor = model.WikiContent.get_label_page(keys[0], by_date=by_date)
 
-    if 'sort=date,desc' in keys:
-        pages.sort(key=lambda p: p.created, reverse=True)
-    else:
+    if not by_date:
         pages.sort(key=lambda p: p.title.lower())
 
     items = []
@@ -150,15 +221,26 @@ def list_pages_by_label(label):
         items.append(u'<li class="list-group-item"><a href="%(url)s" title="%(hint)s">%(title)s</a></li>' % {
             "url": pageurl(page_name),
             "hint": cgi.escape(page_name),
-            "title": page.get_property('display_title', page.title),
+            "title": page.get_display_title(),
         })
 
     if not items:
         return ""
 
+    if cursor:
+        items.append(u'<li class="list-group-item"><a href="%s">More pages…</a></li>' % cgi.escape(get_label_index_url(keys[0], cursor, by_date)))
+
     return u'<ul class="list-group">%s</ul>' % u''.join(items)
 
 
+def get_label_index_url(label, cursor, by_date=False):
+    """Returns the URL of the next batch of pages with the label."""
+    url = '/w/index?label=%s&cursor=%s' % (urllib.quote(label.encode('utf-8')), urllib.quote(cursor))
+    if by_date:
+        url += '&sort=date'
+    return url
+
+
 def process_special_token(text, page_name):
     """Renders special code snippets such as an MP3 player."""
     parts = text.split(';')
@@ -172,7 +254,7 @@ def process_special_token(text, page_name):
         if url is None and page_name is not None:
             page = model.WikiContent.get_by_title(page_name)
             if page is not None:
-                url = page.get_property('file')
+                url = page.get_file()
         if url is None:
             return '<!-- player error: no file -->'
         file_url = cgi.escape(url)
@@ -246,6 +328,13 @@ def get_base_url():
     return url
 
 
+def get_canonical_base_url():
+    """Returns the base URL for links built by background tasks, which can
+    run on a different host name: the base-url setting, or the current
+    host."""
+    return (settings.get('base-url') or get_base_url()).rstrip('/')
+
+
 def cleanup_summary(text):
     text = re.sub('<iframe.*</iframe>', '', text)
     text = cleanup_re_1.sub('', text)
@@ -9,6 +9,8 @@ from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
 
 import access
+import cache
+import diff
 import model
 import settings
 import util
@@ -49,27 +51,49 @@ def render(template_name, data):
     return template.render(filename, data)
 
 
-def get_sidebar():
-    page_name = settings.get('sidebar', 'gaewiki:sidebar')
-    page = model.WikiContent.get_by_title(page_name)
-    if page.is_saved():
-        body = page.body
-    else:
-        body = u'\n\n<h4>This sidebar is used as menu, place your wiki links inside a list with these html tags:</h4>\n\n<code><\\ul class="nav"><\li></code>\n\n<code>[&#173;[SAMPLE_LINK_TO_PAGE]]</code>\n\n<code><\/li><\/ul></code>\n\n[<ul class="nav"><li>Edit the menu</li></ul>](/w/edit?page=%s)' % page_name
-    return body
+def render_part(template_name, data):
+    """Renders a part of a page, without the user specific data that render()
+    adds, so that the result can be shared by all users."""
+    filename = os.path.join(os.path.dirname(__file__), 'templates', template_name)
+    if 'settings' not in data:
+        data['settings'] = settings.get_all()
+    return template.render(filename, data)
 
 
-def get_footer():
-    page_name = settings.get('footer', 'gaewiki:footer')
-    page = model.WikiContent.get_by_title(page_name)
-    if page.is_saved():
-        body = page.body
-    else:
-        body = u'[BGAEWiki](https://github.com/BauweBijl/bgaewiki) by [Bauwe Bijl](http://www.bauwe.nl)'
-    return body
+def get_sidebar():
+    """Returns the rendered sidebar.  The HTML is cached until the sidebar page
+    or the settings are saved, see settings.check_and_flush()."""
+    html = cache.get_fragment('sidebar')
+    if html is None:
+        page_name = settings.get('sidebar', 'gaewiki:sidebar')
+        page = model.WikiContent.get_by_title(page_name)
+        if page.is_saved():
+            body = page.body
+        else:
+            body = u'\n\n<h4>This sidebar is used as menu, place your wiki links inside a list with these html tags:</h4>\n\n<code><\\ul class="nav"><\li></code>\n\n<code>[&#173;[SAMPLE_LINK_TO_PAGE]]</code>\n\n<code><\/li><\/ul></code>\n\n[<ul class="nav"><li>Edit the menu</li></ul>](/w/edit?page=%s)' % page_name
+        html = util.wikify_filter(body)
+        cache.set_fragment('sidebar', html)
+    return html
 
 
-def view_page(page, user=None, is_admin=False, revision=None):
+def get_footer():
+    """Returns the rendered footer, cached like the sidebar."""
+    html = cache.get_fragment('footer')
+    if html is None:
+        page_name = settings.get('footer', 'gaewiki:footer')
+        page = model.WikiContent.get_by_title(page_name)
+        if page.is_saved():
+            body = page.body
+        else:
+            body = u'[BGAEWiki](https://github.com/BauweBijl/bgaewiki) by [Bauwe Bijl](http://www.bauwe.nl)'
+        html = util.wikify_filter(body)
+        cache.set_fragment('footer', html)
+    return html
+
+
+def view_page(page, user=None, is_admin=False, revision=None, body_key=None):
+    """Renders a page.  The page body doesn't depend on the user, it's cached
+    under body_key (if specified) and shared by all users."""
     page = page.get_redirected()
 
     if page.title.startswith("Label:") and not page.body:
@@ -84,11 +108,22 @@ def view_page(page, user=None, is_admin=False, revision=None):
         'revision': revision,
     }
 
+    if page.body:
+        data['page_body'] = body_key and cache.get_rendered(body_key)
+        if not data['page_body']:
+            data['page_body'] = render_part('page_body.html', {
+                'page': page,
+                'is_plain': data['is_plain'],
+                'page_labels': data['page_labels'],
+            })
+            if body_key:
+                cache.set_rendered(body_key, data['page_body'])
+
     # logging.debug(data)
 
     if settings.get('enable-map'):
-        if page.get_property('map_label'):
-            data['map_url'] = '/w/pages/map?label=' + util.uurlencode(page.get_property('map_label'))
+        if page.get_map_label():
+            data['map_url'] = '/w/pages/map?label=' + util.uurlencode(page.get_map_label())
         elif data['can_edit'] or page.geopt:
             data['map_url'] = '/w/map?page=' + util.uurlencode(page.title)
 
@@ -106,10 +141,20 @@ def edit_page(page):
     })
 
 
-def list_pages(pages):
+def list_pages(pages, label=None, next_url=None):
     logging.debug(u'Listing %u pages.' % len(pages))
     return render('index.html', {
         'pages': pages,
+        'label': label,
+        'next_url': next_url,
+    })
+
+
+def show_search_results(query, pages, next_url=None):
+    return render('search.html', {
+        'query': query,
+        'pages': pages,
+        'next_url': next_url,
     })
 
 
@@ -120,29 +165,99 @@ def list_pages_feed(pages):
     })
 
 
-def show_page_history(page, user=None, is_admin=False):
+def show_page_history(page, user=None, is_admin=False, cursor=None):
+    revisions, cursor = page.get_history_page(cursor)
     return render('history.html', {
         'page_title': page.title,
-        'revisions': page.get_history(),
+        # Each revision with the previous one, to link to the changes.
+        'revisions': zip(revisions, revisions[1:] + [None]),
+        'next_cursor': cursor,
         'can_edit': access.can_edit_page(page.title, user, is_admin),
     })
 
 
+def show_diff(page, old, new=None, user=None, is_admin=False):
+    """Renders differences between two revisions, or between a revision and
+    the current version of the page.  Revisions never change, so the
+    differences are cached by the pair of revision keys (or by the time
+    the page was saved)."""
+    if new is None:
+        key = u'Diff:%s:%s' % (old.key(), page.updated)
+    else:
+        key = u'Diff:%s:%s' % (old.key(), new.key())
+    html = cache.get_rendered(key)
+    if html is None:
+        new_body = new is None and (page.body or u'') or new.get_body()
+        html = u''.join(diff.render_html(old.get_body(), new_body))
+        cache.set_rendered(key, html)
+    return render('diff.html', {
+        'page_title': page.title,
+        'old': old,
+        'new': new,
+        'diff': html,
+        'can_edit': access.can_edit_page(page.title, user, is_admin),
+    })
+
+
+LINK_REPORTS = (
+    ('orphans', u'Orphan pages', u'Pages that no other page links to.'),
+    ('wanted', u'Wanted pages', u'Missing pages with the most links to them.'),
+    ('dead', u'Dead links', u'Pages with links to pages that don\'t exist.'),
+    ('important', u'Important pages', u'Pages ranked by links to them, weighted by importance of the linking pages.'),
+)
+
+
+def show_link_report(name, report=None, info=None):
+    """Shows a link graph report, or the list of reports if name is
+    empty."""
+    rows = []
+    for item in report or []:
+        if name == 'orphans':
+            rows.append({'title': item})
+        elif name == 'dead':
+            rows.append({'title': item[0], 'links': item[1]})
+        else:
+            rows.append({'title': item[0], 'value': item[1]})
+    titles = dict([(report_name, title) for report_name, title, description in LINK_REPORTS])
+    return render('link_report.html', {
+        'name': name,
+        'report_title': titles.get(name, u'Link reports'),
+        'reports': LINK_REPORTS,
+        'rows': rows,
+        'info': info,
+    })
+
+
 def get_sitemap(pages):
     return render('sitemap.xml', {
         'pages': pages,
     })
 
 
-def get_change_list(pages):
-    return render('changes.html', {
+def get_sitemap_shard(pages):
+    """Renders a part of the sitemap, see model.SitemapShard."""
+    return render_part('sitemap.xml', {
         'pages': pages,
+        'base': util.get_canonical_base_url(),
     })
 
 
-def get_change_feed(pages):
+def get_sitemap_index(shards):
+    return render_part('sitemap_index.xml', {
+        'shards': shards,
+        'base': util.get_base_url(),
+    })
+
+
+def get_change_list(changes):
+    return render('changes.html', {
+        'changes': changes,
+    })
+
+
+def get_change_feed(changes):
     return render('changes.rss', {
-        'pages': pages,
+        'changes': changes,
     })
 
 
@@ -244,10 +359,11 @@ def view_image(img, user, is_admin):
     return render("view_image.html", data)
 
 
-def view_image_list(lst, user, is_admin):
+def view_image_list(lst, user, is_admin, cursor=None):
     data = {
         "images": lst,
         "user": user,
         "is_admin": is_admin,
+        "next_cursor": cursor,
     }
     return render("image_list.html", data)